@@ -0,0 +1,77 @@
+# 関数アプリ側に functionApp/get_shogi_move/abstraction.py として同じ内容の複製がある（変更する場合は両方をそろえること）
+import zlib
+from typing import Dict, Optional, Sequence
+
+# 情報集合の抽象化の設定（モデルのメタデータにそのまま保存し、推論側も同じ設定で抽象化する）
+DEFAULT_ABSTRACTION = {
+    'num_buckets': 1 << 16,  # バケット数（情報集合の数の上限）
+    'king_radius': 1,        # 自玉の周囲何マスまでを特徴に含めるか
+    'material_step': 300,    # 駒得を何点刻みで区切るか
+    'material_limit': 8,     # 駒得の区分の上限（±）
+    'hand_cap': 2,           # 持ち駒の枚数をいくつで頭打ちにするか
+}
+
+# 成り駒 -> 元の駒
+UNPROMOTED = {1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 6: 6, 7: 7, 8: 8, 11: 1, 12: 2, 13: 3, 14: 4, 15: 5, 17: 7}
+# 駒得の計算に使う元の駒の価値（玉は数えない）
+MATERIAL_VALUES = {1: 100, 2: 400, 3: 450, 4: 500, 5: 800, 6: 600, 7: 900, 8: 0}
+# 先後の駒を合わせた価値の合計
+TOTAL_MATERIAL = 2 * (9 * 100 + 2 * 400 + 2 * 450 + 2 * 500 + 800 + 2 * 600 + 900)
+HAND_PIECES = (1, 2, 3, 4, 5, 6, 7, 8)
+OFF_BOARD = 0x7F
+
+
+def make_abstraction(**overrides) -> Dict[str, int]:
+    """既定値に指定した値を上書きした設定を返す"""
+    unknown = set(overrides) - set(DEFAULT_ABSTRACTION)
+    if unknown:
+        raise ValueError(f"不明な抽象化の設定です: {sorted(unknown)}")
+    return {**DEFAULT_ABSTRACTION, **overrides}
+
+
+def abstract_features(values: Sequence[int], side: int, own_hand: Dict[int, int], opponent_hand: Dict[int, int],
+                      config: Dict[str, int]) -> bytes:
+    """手番側から見える駒（81マス、見えないマスは0）と持ち駒から抽象化の特徴量を作る
+
+    - 自玉の位置と、その周囲の見えている駒
+    - 自分の駒（盤上と持ち駒）の価値から求めた駒得の区分
+    - 双方の持ち駒の枚数（hand_capで頭打ち）
+    """
+    features = bytearray([side & 0xFF])
+
+    king = next((square for square, value in enumerate(values) if value == 8 * side), None)
+    radius = config['king_radius']
+    if king is None:
+        features.append(OFF_BOARD)
+    else:
+        i, j = divmod(king, 9)
+        features.append(king)
+        for di in range(-radius, radius + 1):
+            for dj in range(-radius, radius + 1):
+                ni, nj = i + di, j + dj
+                if 0 <= ni < 9 and 0 <= nj < 9:
+                    features.append(values[ni * 9 + nj] * side + 32)  # 自分の駒を正の値にそろえる
+                else:
+                    features.append(OFF_BOARD)
+
+    # 駒は先後合わせて一定なので、自分の駒の価値だけで駒得が決まる（見えない駒に依存しない）
+    own_material = sum(MATERIAL_VALUES[UNPROMOTED[value * side]] for value in values if value * side > 0)
+    own_material += sum(MATERIAL_VALUES[UNPROMOTED[piece]] * count for piece, count in own_hand.items())
+    limit = config['material_limit']
+    balance = (2 * own_material - TOTAL_MATERIAL) // config['material_step']
+    features.append(max(-limit, min(limit, balance)) + limit)
+
+    cap = config['hand_cap']
+    for hand in (own_hand, opponent_hand):
+        counts = {piece: 0 for piece in HAND_PIECES}
+        for piece, count in hand.items():
+            counts[UNPROMOTED[piece]] += count
+        features.extend(min(counts[piece], cap) for piece in HAND_PIECES)
+    return bytes(features)
+
+
+def abstract_bucket(values: Sequence[int], side: int, own_hand: Dict[int, int], opponent_hand: Dict[int, int],
+                    config: Optional[Dict[str, int]] = None) -> int:
+    """特徴量をnum_buckets個のバケットのどれかに割り当てる（実行環境によらず同じ値になるようcrc32を使う）"""
+    config = config or DEFAULT_ABSTRACTION
+    return zlib.crc32(abstract_features(values, side, own_hand, opponent_hand, config)) % config['num_buckets']
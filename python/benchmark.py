@@ -0,0 +1,213 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from training import FogShogiState, FogShogiCFR
+
+# 盤面の数値表現 -> エンドポイントの駒の種類
+PIECE_TYPES = {
+    1: "歩", 2: "香", 3: "桂", 4: "銀", 5: "角", 6: "金", 7: "飛", 8: "王",
+    11: "と", 12: "成香", 13: "成桂", 14: "成銀", 15: "馬", 17: "龍"
+}
+
+# ベンチマーク用の局面（名前, 乱数シード, ランダムに進める手数, 駒を取る手を優先するか）
+# 持ち駒のある局面は、実際に駒を取り合って作る（駒の総数が実戦と同じになるように）
+POSITION_CORPUS = [
+    ("initial", 0, 0, False),
+    ("opening", 1, 12, False),
+    ("midgame", 2, 30, False),
+    ("midgame_hands", 3, 24, True),
+]
+# cfr_iterationの計測で読む深さ（学習の既定値と同じ）
+DEFAULT_CFR_DEPTH = 8
+
+FUNCTION_APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'functionApp')
+# 新しいプロセスで関数を読み込み、最初のリクエストを処理するまでを計る
+# （azure.functionsは関数のワーカーが先に読み込んでいるので計測の対象外にする）
+COLD_START_SCRIPT = """
+import json, sys, time
+import azure.functions as func
+start = time.perf_counter()
+import get_shogi_move
+import_ms = (time.perf_counter() - start) * 1000
+body = json.dumps({'fullBoard': json.loads(sys.argv[1]), 'visibleBoard': json.loads(sys.argv[2]), 'player': sys.argv[3]})
+get_shogi_move.main(func.HttpRequest(method='POST', url='/api/get_shogi_move', body=body.encode()))
+report = get_shogi_move.get_cold_start_report()
+report['import_ms'] = import_ms
+print(json.dumps(report))
+"""
+
+
+def build_position(seed: int, plies: int, prefer_captures: bool = False) -> FogShogiState:
+    """初期局面から固定シードでランダムな合法手を指し進めた局面を作る
+
+    prefer_capturesがTrueなら、玉以外の駒を取る手があればその中から選ぶ。
+    """
+    rng = random.Random(seed)
+    state = FogShogiState()
+    for _ in range(plies):
+        if state.is_terminal():
+            break
+        actions = state.get_legal_actions()
+        if not actions:
+            break
+        if prefer_captures:
+            captures = [a for a in actions if a[0] != -1 and abs(int(state.board[a[2], a[3]])) not in (0, 8)]
+            actions = captures or actions
+        state.apply_action(rng.choice(actions))
+    return state
+
+
+def build_corpus() -> Dict[str, FogShogiState]:
+    return {name: build_position(seed, plies, prefer_captures)
+            for name, seed, plies, prefer_captures in POSITION_CORPUS}
+
+
+def to_endpoint_board(state: FogShogiState, viewer: Optional[int] = None) -> List[List[Optional[Dict]]]:
+    # FogShogiStateの盤面をエンドポイントの形式に変換する
+    # viewerを指定すると、フロントエンドのvisibleBoardと同じく見えないマスの相手の駒を空にする（自分の駒は常に見える）
+    board = [[None for _ in range(9)] for _ in range(9)]
+    for i in range(9):
+        for j in range(9):
+            value = int(state.board[i, j])
+            if value == 0 or (viewer is not None and value * viewer < 0 and state.is_hidden(i, j, viewer)):
+                continue
+            board[i][j] = {"type": PIECE_TYPES[abs(value)], "player": "先手" if value > 0 else "後手"}
+    return board
+
+
+def time_call(func: Callable[[], object], number: int, repeat: int) -> Dict[str, float]:
+    """funcをnumber回呼ぶ計測をrepeat回行い、1回あたりの秒数を返す"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return {
+        'number': number,
+        'repeat': repeat,
+        'min_sec': min(timings),
+        'median_sec': statistics.median(timings),
+        'max_sec': max(timings),
+    }
+
+
+def measure_cold_start(state: FogShogiState, repeat: int) -> Dict[str, Dict[str, float]]:
+    """関数の読み込み時間と最初のリクエストの処理時間を、新しいプロセスでrepeat回計る"""
+    player = "先手" if state.turn == 1 else "後手"
+    args = [json.dumps(to_endpoint_board(state)), json.dumps(to_endpoint_board(state, viewer=state.turn)), player]
+    samples = {'import_ms': [], 'first_request_ms': []}
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT, *args], cwd=FUNCTION_APP_DIR,
+                                capture_output=True, text=True, check=True).stdout
+        report = json.loads(output.strip().splitlines()[-1])
+        for key in samples:
+            samples[key].append(report[key] / 1000)
+    return {
+        key: {'number': 1, 'repeat': repeat, 'min_sec': min(values),
+              'median_sec': statistics.median(values), 'max_sec': max(values)}
+        for key, values in samples.items()
+    }
+
+
+def run_benchmarks(number: int = 5, repeat: int = 3, include_cfr: bool = True,
+                   include_endpoint: bool = True, seed: int = 0, cfr_depth: int = DEFAULT_CFR_DEPTH) -> Dict:
+    random.seed(seed)
+    np.random.seed(seed)
+
+    corpus = build_corpus()
+    cfr_model = FogShogiCFR()
+    results = {}
+
+    def record(name: str, position: str, func: Callable[[], object], n: int = number, r: int = repeat):
+        random.seed(seed)
+        results[f"{name}[{position}]"] = {'benchmark': name, 'position': position, **time_call(func, n, r)}
+
+    for position, state in corpus.items():
+        record('get_legal_actions', position, state.get_legal_actions)
+        record('update_fog', position, state.update_fog)
+        record('is_checkmate', position, lambda: state.is_checkmate(state.turn))
+        record('evaluate_position', position, lambda: cfr_model.evaluate_position(state, state.turn))
+
+    if include_cfr:
+        # キャッシュの影響を除くため、毎回新しいモデルで1イテレーションを実行する
+        record('cfr_iteration', 'initial', lambda: FogShogiCFR().cfr_iteration(1, 1, cfr_depth), n=1, r=1)
+
+    if include_endpoint:
+        try:
+            from functionApp.get_shogi_move import get_cpu_move, get_safe_moves
+        except ImportError as e:
+            print(f"エンドポイントのベンチマークをスキップします: {e}", file=sys.stderr)
+        else:
+            for position, state in corpus.items():
+                player = "先手" if state.turn == 1 else "後手"
+                full_board = to_endpoint_board(state)
+                visible_board = to_endpoint_board(state, viewer=state.turn)
+                record('get_cpu_move', position, lambda: get_cpu_move(visible_board, player))
+                record('get_safe_moves', position, lambda: get_safe_moves(full_board, visible_board, player))
+
+            for key, timing in measure_cold_start(corpus['initial'], repeat).items():
+                name = f"cold_start_{key[:-3]}"
+                results[f"{name}[initial]"] = {'benchmark': name, 'position': 'initial', **timing}
+
+    return {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'seed': seed,
+        'cfr_depth': cfr_depth,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="霧将棋のホットパスのベンチマーク")
+    parser.add_argument('--output', help="結果を書き出すJSONファイル")
+    parser.add_argument('--number', type=int, default=5, help="1回の計測で呼び出す回数")
+    parser.add_argument('--repeat', type=int, default=3, help="計測の繰り返し回数")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-cfr', action='store_true', help="cfr_iterationの計測を省略する")
+    parser.add_argument('--cfr-depth', type=int, default=DEFAULT_CFR_DEPTH, help="cfr_iterationの計測で読む深さ")
+    parser.add_argument('--skip-endpoint', action='store_true', help="エンドポイントの計測を省略する")
+    parser.add_argument('--cold-start-budget-ms', type=float,
+                        help="関数の読み込みと最初のリクエストの合計（中央値）の上限。超えたら終了コード1を返す")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.number, args.repeat, not args.skip_cfr, not args.skip_endpoint, args.seed,
+                            args.cfr_depth)
+
+    for name, result in report['results'].items():
+        print(f"{name:40s} median {result['median_sec'] * 1000:10.3f} ms  min {result['min_sec'] * 1000:10.3f} ms")
+
+    over_budget = False
+    if args.cold_start_budget_ms is not None and 'cold_start_import[initial]' in report['results']:
+        results = report['results']
+        cold_start_ms = (results['cold_start_import[initial]']['median_sec']
+                         + results['cold_start_first_request[initial]']['median_sec']) * 1000
+        over_budget = cold_start_ms > args.cold_start_budget_ms
+        report['cold_start_budget_ms'] = args.cold_start_budget_ms
+        report['cold_start_ms'] = cold_start_ms
+        print(f"コールドスタート: {cold_start_ms:.1f} ms (上限 {args.cold_start_budget_ms:.1f} ms)"
+              + (" 上限を超えています" if over_budget else ""))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"結果を {args.output} に保存しました。")
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
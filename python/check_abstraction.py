@@ -0,0 +1,87 @@
+import argparse
+import random
+import sys
+from typing import Dict, Tuple
+
+from abstraction import make_abstraction
+from benchmark import PIECE_TYPES, to_endpoint_board
+from training import FogShogiCFR, FogShogiState, mirror_action
+
+
+def random_position(rng: random.Random, max_plies: int) -> FogShogiState:
+    # 初期局面からランダムな手数だけ指し進めた、終局していない局面を作る
+    while True:
+        state = FogShogiState()
+        for _ in range(rng.randrange(max_plies + 1)):
+            actions = state.get_legal_actions()
+            if state.is_terminal() or not actions:
+                break
+            state.apply_action(rng.choice(actions))
+        if not state.is_terminal():
+            return state
+
+
+def to_endpoint_hands(state: FogShogiState) -> Dict[str, Dict[str, int]]:
+    # 持ち駒をエンドポイントのcount_captured_piecesと同じ形式（プレイヤー -> 駒の種類 -> 枚数）にする
+    return {("先手" if player == 1 else "後手"): {PIECE_TYPES[piece]: count for piece, count in hand.items()}
+            for player, hand in state.captured_pieces.items()}
+
+
+def compare_buckets(num_positions: int, canonicalize: bool, seed: int, max_plies: int) -> Tuple[int, int, int, int]:
+    """学習側とエンドポイントが同じ局面に同じバケット番号を割り当て、学習した手を実際に返すかを調べる
+
+    (バケットの不一致の数, 反転の判定の不一致の数, 戦略テーブルの手を返さなかった数, 調べた手の数) を返す。
+    手の確認では、学習側の情報集合に1つの手だけを持つ戦略テーブルを作り、get_cpu_moveがその手を返すかを見る。
+    """
+    from functionApp.get_shogi_move import get_abstract_information_set, get_cpu_move, get_legal_actions, is_mirror_smaller
+
+    rng = random.Random(seed)
+    model = FogShogiCFR(canonicalize=canonicalize, abstraction=make_abstraction())
+    bucket_mismatches = mirror_mismatches = move_misses = moves_checked = 0
+    for _ in range(num_positions):
+        state = random_position(rng, max_plies)
+        player = "先手" if state.turn == 1 else "後手"
+        hands = to_endpoint_hands(state)
+        # get_cpu_moveと同じ手順でバケット番号を求める
+        board = to_endpoint_board(state, viewer=state.turn)
+        mirrored = canonicalize and is_mirror_smaller(board)
+        lookup_board = [list(reversed(row)) for row in board] if mirrored else board
+        bucket = get_abstract_information_set(lookup_board, player, hands, model.abstraction)
+
+        expected, expected_mirrored = model.get_canonical_information_set(state)
+        bucket_mismatches += bucket != expected
+        mirror_mismatches += mirrored != expected_mirrored
+
+        # 学習側と同じ向き・形式（成りのフラグつき）で手を登録し、エンドポイントがその手を選ぶかを確かめる
+        endpoint_actions = set(get_legal_actions(board, player))
+        candidates = [a for a in state.get_legal_actions() if a[0] != -1 and a[:4] in endpoint_actions]
+        if not candidates:
+            continue
+        action = rng.choice(candidates)
+        table_action = mirror_action(action) if expected_mirrored else action
+        model_data = {'canonical': canonicalize, 'abstraction': model.abstraction,
+                      'regret_sum': {}, 'strategy_sum': {expected: {table_action: 1.0}}}
+        moves_checked += 1
+        move_misses += get_cpu_move(board, player, model_data, budget_ms=1, hands=hands) != action[:4]
+    return bucket_mismatches, mirror_mismatches, move_misses, moves_checked
+
+
+def main():
+    parser = argparse.ArgumentParser(description="学習側とエンドポイントの情報集合の抽象化が一致するかを確認する")
+    parser.add_argument('--positions', type=int, default=800, help="確認する局面の数")
+    parser.add_argument('--max-plies', type=int, default=60, help="局面を作るときにランダムに指し進める最大手数")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    failed = False
+    for canonicalize in (False, True):
+        buckets, mirrors, misses, checked = compare_buckets(args.positions, canonicalize, args.seed, args.max_plies)
+        print(f"左右反転{'あり' if canonicalize else 'なし'}: バケットの不一致 {buckets}/{args.positions}, "
+              f"反転の判定の不一致 {mirrors}/{args.positions}, 学習した手を返さなかった局面 {misses}/{checked}")
+        failed = failed or buckets > 0 or mirrors > 0 or misses > 0
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
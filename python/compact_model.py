@@ -0,0 +1,141 @@
+import argparse
+import os
+import pickle
+from typing import Dict, Tuple
+
+from model_io import load_model_file, save_model_stream
+
+
+def normalize_strategy(strategy_sum: Dict) -> Dict:
+    # 戦略の合計を確率に変換する（合計が0なら一様分布）
+    total = sum(strategy_sum.values())
+    if total > 0:
+        return {action: value / total for action, value in strategy_sum.items()}
+    return {action: 1.0 / len(strategy_sum) for action in strategy_sum}
+
+
+def compact_strategy(strategy_sum: Dict, threshold: float, bits: int) -> Dict:
+    """確率がthreshold未満の行動を削除し、残りを最大値基準のbitsビット整数に量子化する"""
+    probabilities = normalize_strategy(strategy_sum)
+    best = max(probabilities.values())
+    scale = (1 << bits) - 1 if bits else None
+
+    compacted = {}
+    for action, p in probabilities.items():
+        # 最も確率の高い行動は必ず残す
+        if p < threshold and p < best:
+            continue
+        if scale is None:
+            compacted[action] = p
+        else:
+            q = round(p / best * scale)
+            if q > 0:
+                compacted[action] = q
+    return compacted
+
+
+def compact_model(model_data: Dict, threshold: float = 0.01, bits: int = 8) -> Dict:
+    """regret_sumを捨て、strategy_sumを枝刈り・量子化したモデルを返す
+
+    量子化後の値は整数だが、推論側の get_average_strategy は合計で正規化するので
+    そのまま確率として扱える。bits=0 の場合は量子化せず確率(float)のまま保存する。
+    """
+    strategy_sum = {}
+    for info_set, strategy in model_data['strategy_sum'].items():
+        if strategy:
+            strategy_sum[info_set] = compact_strategy(strategy, threshold, bits)
+    # 正規化の有無などの設定はそのまま引き継ぐ
+    metadata = {key: value for key, value in model_data.items() if key not in ('regret_sum', 'strategy_sum')}
+    return {**metadata, 'regret_sum': {}, 'strategy_sum': strategy_sum}
+
+
+def compare_models(original: Dict, compacted: Dict) -> Dict[str, float]:
+    # 元のモデルと圧縮後のモデルの方策の差を測る
+    agree = 0
+    total_variation = 0.0
+    kept_actions = 0
+    original_actions = 0
+    for info_set, strategy in original['strategy_sum'].items():
+        if not strategy:
+            continue
+        before = normalize_strategy(strategy)
+        after = normalize_strategy(compacted['strategy_sum'].get(info_set, {}) or strategy)
+        if max(before, key=before.get) == max(after, key=after.get):
+            agree += 1
+        total_variation += 0.5 * sum(abs(before.get(a, 0.0) - after.get(a, 0.0)) for a in before)
+        original_actions += len(strategy)
+        kept_actions += len(compacted['strategy_sum'].get(info_set, {}))
+
+    num_info_sets = max(len(original['strategy_sum']), 1)
+    return {
+        'info_sets': len(original['strategy_sum']),
+        'actions_before': original_actions,
+        'actions_after': kept_actions,
+        'best_move_agreement': agree / num_info_sets,
+        'mean_total_variation': total_variation / num_info_sets,
+    }
+
+
+def play_match(model_a: Dict, model_b: Dict, num_games: int) -> Tuple[int, int, int]:
+    # 先後を入れ替えながら対戦させ、(Aの勝ち, Bの勝ち, 引き分け) を返す
+    from sim import simulate_game
+
+    a_wins = b_wins = draws = 0
+    for game in range(num_games):
+        if game % 2 == 0:
+            winner = simulate_game(model_a, model_b)
+            a_first = True
+        else:
+            winner = simulate_game(model_b, model_a)
+            a_first = False
+        if winner is None:
+            draws += 1
+        elif (winner == "先手") == a_first:
+            a_wins += 1
+        else:
+            b_wins += 1
+    return a_wins, b_wins, draws
+
+
+def main():
+    parser = argparse.ArgumentParser(description="学習済みモデルを配布用に圧縮する")
+    parser.add_argument('input', help="入力モデル（pickle形式またはストリーミング形式）")
+    parser.add_argument('output', help="出力モデルのパス")
+    parser.add_argument('--threshold', type=float, default=0.01, help="この確率未満の行動を削除する")
+    parser.add_argument('--bits', type=int, choices=[0, 8, 16], default=8, help="量子化ビット数（0は量子化しない）")
+    parser.add_argument('--streaming', action='store_true', help="ストリーミング形式で保存する（関数アプリのget_model_dataもこの形式を読める）")
+    parser.add_argument('--compression', default='zlib', help="ストリーミング形式の圧縮方式")
+    parser.add_argument('--games', type=int, default=0,
+                        help="元のモデルと対戦させる対局数（推論側が戦略テーブルを引ける、抽象化したモデルのみ）")
+    args = parser.parse_args()
+
+    original = load_model_file(args.input)
+    compacted = compact_model(original, args.threshold, args.bits)
+
+    if args.streaming:
+        metadata = {key: value for key, value in compacted.items() if key not in ('regret_sum', 'strategy_sum')}
+        save_model_stream(args.output, None, compacted['strategy_sum'], compression=args.compression, metadata=metadata)
+    else:
+        with open(args.output, 'wb') as f:
+            pickle.dump(compacted, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    size_before = os.path.getsize(args.input)
+    size_after = os.path.getsize(args.output)
+    stats = compare_models(original, compacted)
+
+    print(f"サイズ: {size_before} -> {size_after} バイト ({size_after / max(size_before, 1) * 100:.1f}%)")
+    print(f"情報集合数: {stats['info_sets']}")
+    print(f"行動数: {stats['actions_before']} -> {stats['actions_after']}")
+    print(f"最善手の一致率: {stats['best_move_agreement'] * 100:.2f}%")
+    print(f"方策の平均全変動距離: {stats['mean_total_variation']:.4f}")
+
+    if args.games > 0 and not original.get('abstraction'):
+        # 文字列の情報集合のモデルは推論側で戦略テーブルを引けず、両者とも同じ探索で指すので対戦しても差が出ない
+        print("抽象化していないモデルは推論側で戦略テーブルを引けないため、対戦は行いません。")
+    elif args.games > 0:
+        a_wins, b_wins, draws = play_match(compacted, original, args.games)
+        print(f"対戦結果 (圧縮後 vs 元): {a_wins}勝 {b_wins}敗 {draws}分")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,512 @@
+import argparse
+import ipaddress
+import json
+import multiprocessing
+import os
+import pickle
+import socket
+import time
+import uuid
+from multiprocessing.connection import AuthenticationError, Client, Listener
+from typing import Callable, Dict, List, Optional, Tuple
+
+from abstraction import make_abstraction
+from training import BOTH_PLAYERS, CFRProfiler, FogShogiCFR
+
+DEFAULT_ADDRESS = "127.0.0.1:5555"
+DEFAULT_AUTHKEY = os.environ.get('FOG_SHOGI_AUTHKEY')
+# 認証キーを指定しない場合に使うキー（公開されている値なので、ループバックアドレスで待ち受けるときだけ使う）
+LOOPBACK_AUTHKEY = 'fog-shogi'
+BATCH_TIMEOUT = 600.0  # この秒数を過ぎても結果が返らないバッチは別のワーカーに割り当て直す
+IDLE_TIMEOUT = 60.0  # バッチを持たずにこの秒数要求が来ないワーカーは終了したものとみなす
+POLL_INTERVAL = 0.05
+WAIT_SECONDS = 1.0
+MAX_RETRIES = 5  # 通信に失敗したときの再試行回数（間隔はRETRY_DELAYから倍々に延ばす）
+RETRY_DELAY = 0.5
+
+
+def merge_tables(target: Dict, delta: Dict):
+    # 疎な差分（情報集合 -> 行動 -> 値）を加算する
+    for info_set, values in delta.items():
+        entry = target.setdefault(info_set, {})
+        for action, value in values.items():
+            entry[action] = entry.get(action, 0) + value
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def is_loopback(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        # ホスト名は名前解決した結果で判断する（空文字列は全インターフェースなのでループバックではない）
+        try:
+            return bool(host) and ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+        except OSError:
+            return False
+
+
+def resolve_authkey(address: str, authkey: Optional[str]) -> str:
+    """socket通信に使う認証キーを返す
+
+    通信はpickleなので、認証キーを知っている相手はコーディネーター上で任意のコードを実行できる。
+    公開されている既定のキーはループバックアドレスに限って使い、それ以外では明示的な指定を求める。
+    """
+    host, _ = parse_address(address)
+    if is_loopback(host):
+        return authkey or LOOPBACK_AUTHKEY
+    if authkey and authkey != LOOPBACK_AUTHKEY:
+        return authkey
+    raise ValueError(f"ループバック以外のアドレス（{address}）を使う場合は、--authkey か環境変数 "
+                     "FOG_SHOGI_AUTHKEY で推測されにくい認証キーを指定してください。")
+
+
+class SocketServer:
+    """コーディネーター側のソケット通信（1回の接続で1つの要求を受けて1つの応答を返す）"""
+
+    def __init__(self, address: str, authkey: str):
+        self.listener = Listener(parse_address(address), authkey=authkey.encode())
+
+    def next_request(self) -> Optional[Tuple[Dict, Callable[[Dict], None]]]:
+        # 期限切れのバッチの割り当て直しもワーカーの要求を契機に行うので、要求が来るまで待ってよい
+        # 認証に失敗した接続や、送信の途中で切れた接続はその接続だけを捨てて待ち受けを続ける
+        try:
+            connection = self.listener.accept()
+        except (AuthenticationError, EOFError, OSError) as e:
+            print(f"接続を受け付けられませんでした: {e!r}")
+            return None
+        try:
+            message = connection.recv()
+        except (EOFError, OSError) as e:
+            print(f"要求を受信できませんでした: {e!r}")
+            connection.close()
+            return None
+
+        def respond(reply: Dict):
+            # 応答を受け取る前にワーカーが落ちた場合、割り当てたバッチは期限切れ後に割り当て直される
+            try:
+                connection.send(reply)
+            except OSError as e:
+                print(f"応答を送信できませんでした: {e!r}")
+            finally:
+                connection.close()
+        return message, respond
+
+    def close(self):
+        self.listener.close()
+
+
+class SocketClient:
+    def __init__(self, address: str, authkey: str):
+        self.address = parse_address(address)
+        self.authkey = authkey.encode()
+        self.connected = False  # 一度でもコーディネーターと通信できたかどうか
+
+    def request(self, message: Dict) -> Optional[Dict]:
+        """要求を送って応答を返す。コーディネーターが終了した（または通信できない）場合はNone
+
+        起動前で接続を拒否された場合や、途中で接続が切れた場合は間隔を延ばしながら再試行する。
+        同じ要求を送り直しても、二重に届いた結果はコーディネーターが捨てる。
+        """
+        delay = RETRY_DELAY
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                with Client(self.address, authkey=self.authkey) as connection:
+                    connection.send(message)
+                    reply = connection.recv()
+                self.connected = True
+                return reply
+            except AuthenticationError as e:
+                print(f"コーディネーターの認証に失敗しました（認証キーを確認してください）: {e!r}")
+                return None
+            except ConnectionRefusedError as e:
+                if self.connected:
+                    return None  # 通信できていたコーディネーターが待ち受けをやめた = 学習が終わった
+                error = e
+            except (OSError, EOFError) as e:
+                error = e
+            if attempt < MAX_RETRIES:
+                time.sleep(delay)
+                delay *= 2
+        print(f"コーディネーターと通信できないので終了します: {error!r}")
+        return None
+
+
+def _write_atomic(path: str, obj):
+    # 書きかけのファイルを読まれないよう、別名で書いてから置き換える
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+class FileServer:
+    """コーディネーター側のファイル通信（共有ディレクトリのrequests/に置かれた要求に、replies/へ応答を書く）"""
+
+    def __init__(self, directory: str):
+        self.requests = os.path.join(directory, 'requests')
+        self.replies = os.path.join(directory, 'replies')
+        self.stop_path = os.path.join(directory, 'STOP')
+        os.makedirs(self.requests, exist_ok=True)
+        os.makedirs(self.replies, exist_ok=True)
+        # 前回の実行で残った要求・応答と終了の合図を消しておく
+        for path in [os.path.join(d, name) for d in (self.requests, self.replies) for name in os.listdir(d)] + [self.stop_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def next_request(self) -> Optional[Tuple[Dict, Callable[[Dict], None]]]:
+        deadline = time.time() + WAIT_SECONDS
+        while time.time() < deadline:
+            names = sorted(name for name in os.listdir(self.requests) if name.endswith('.pkl'))
+            if names:
+                path = os.path.join(self.requests, names[0])
+                with open(path, 'rb') as f:
+                    message = pickle.load(f)
+                os.remove(path)
+
+                def respond(reply: Dict, name=names[0]):
+                    _write_atomic(os.path.join(self.replies, name), reply)
+                return message, respond
+            time.sleep(POLL_INTERVAL)
+        return None
+
+    def close(self):
+        # 待っているワーカーに終了を知らせる
+        open(self.stop_path, 'w').close()
+
+
+class FileClient:
+    def __init__(self, directory: str, timeout: float = BATCH_TIMEOUT):
+        self.requests = os.path.join(directory, 'requests')
+        self.replies = os.path.join(directory, 'replies')
+        self.stop_path = os.path.join(directory, 'STOP')
+        self.timeout = timeout
+
+    def request(self, message: Dict) -> Optional[Dict]:
+        name = f"{time.time_ns()}-{uuid.uuid4().hex}.pkl"
+        # コーディネーターがまだrequests/を作っていない場合は間隔を延ばしながら再試行する
+        delay = RETRY_DELAY
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                _write_atomic(os.path.join(self.requests, name), message)
+                break
+            except OSError as e:
+                if attempt == MAX_RETRIES:
+                    print(f"要求を書き込めないので終了します: {e!r}")
+                    return None
+                time.sleep(delay)
+                delay *= 2
+        reply_path = os.path.join(self.replies, name)
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            if os.path.exists(reply_path):
+                try:
+                    with open(reply_path, 'rb') as f:
+                        reply = pickle.load(f)
+                    os.remove(reply_path)
+                except (OSError, EOFError, pickle.UnpicklingError) as e:
+                    print(f"応答を読み込めないので終了します: {e!r}")
+                    return None
+                return reply
+            if os.path.exists(self.stop_path):
+                return None
+            time.sleep(POLL_INTERVAL)
+        return None
+
+
+def make_server(transport: str, address: str, authkey: str):
+    return SocketServer(address, authkey) if transport == 'socket' else FileServer(address)
+
+
+def make_client(transport: str, address: str, authkey: str):
+    return SocketClient(address, authkey) if transport == 'socket' else FileClient(address)
+
+
+class Coordinator:
+    """イテレーションのバッチをワーカーに配り、返ってきた後悔・戦略の差分をまとめてチェックポイントを保存する
+
+    各ワーカーには初回に全体のテーブルを送り、以降は他のワーカーの差分をまとめたものだけを送る。
+    """
+
+    def __init__(self, model: FogShogiCFR, iterations: int, batch_size: int, players: List[int],
+                 filename: str, checkpoint_interval: int, streaming: bool = False, max_depth: int = 8):
+        self.model = model
+        self.max_depth = max_depth
+        self.filename = filename
+        self.checkpoint_interval = checkpoint_interval
+        self.streaming = streaming
+        # バッチID -> (プレイヤー, イテレーション番号のリスト)
+        self.batches = {}
+        for batch_start in range(0, iterations, batch_size):
+            for player in players:
+                batch_id = f"{player}:{batch_start}"
+                self.batches[batch_id] = (player, list(range(batch_start, min(batch_start + batch_size, iterations))))
+        self.pending = list(self.batches)
+        self.assigned: Dict[str, Tuple[str, float]] = {}  # バッチID -> (ワーカー, 割り当て時刻)
+        self.completed = set()
+        self.worker_deltas: Dict[str, Tuple[Dict, Dict]] = {}  # ワーカー -> まだ送っていない他のワーカーの差分
+        self.last_pull: Dict[str, float] = {}  # ワーカー -> 最後にバッチを要求した時刻
+        self.completed_iterations = 0
+        self.last_checkpoint = 0
+        self.utilities = []
+
+    @property
+    def progress_path(self) -> str:
+        return os.path.join('models', f"{self.filename}_progress.json")
+
+    def resume(self):
+        # 前回の進捗ファイルがあれば、最後のチェックポイントを読み込んで完了済みのバッチを飛ばす
+        if not os.path.exists(self.progress_path):
+            return
+        with open(self.progress_path) as f:
+            progress = json.load(f)
+        loaded = FogShogiCFR.load_model(progress['checkpoint'])
+        # 情報集合の作り方が違うと文字列のキーとバケット番号のキーが1つのテーブルに混ざるので、設定が同じ場合だけ再開する
+        saved = {'canonicalize': loaded.canonicalize, 'abstraction': loaded.abstraction}
+        current = {'canonicalize': self.model.canonicalize, 'abstraction': self.model.abstraction}
+        if saved != current:
+            raise ValueError(f"{progress['checkpoint']} は別の設定で学習されています（チェックポイント: {saved}, "
+                             f"指定: {current}）。--canonicalize と --buckets をチェックポイントに合わせてください。")
+        self.model.regret_sum = loaded.regret_sum
+        self.model.strategy_sum = loaded.strategy_sum
+        self.completed = set(progress['completed']) & set(self.batches)
+        self.pending = [batch_id for batch_id in self.pending if batch_id not in self.completed]
+        self.completed_iterations = self.last_checkpoint = progress['completed_iterations']
+        print(f"{progress['checkpoint']} から再開します（完了済みバッチ {len(self.completed)} 件）")
+
+    def finished(self) -> bool:
+        return len(self.completed) == len(self.batches)
+
+    def handle(self, message: Dict) -> Dict:
+        if message['type'] == 'pull':
+            return self.handle_pull(message['worker'])
+        if message['type'] == 'push':
+            return self.handle_push(message)
+        return {'type': 'error', 'reason': f"unknown message type: {message['type']}"}
+
+    def next_batch(self) -> Optional[str]:
+        if self.pending:
+            return self.pending.pop(0)
+        # 期限切れのバッチ（ワーカーが落ちた可能性がある）を割り当て直す
+        now = time.time()
+        for batch_id, (worker, assigned_at) in self.assigned.items():
+            if now - assigned_at > BATCH_TIMEOUT:
+                # 落ちたワーカー宛ての差分がたまり続けないよう捨てる（戻ってきたら全体を送り直す）
+                self.worker_deltas.pop(worker, None)
+                return batch_id
+        return None
+
+    def expire_idle_workers(self):
+        # バッチを持たずに要求が途絶えたワーカー（終了したワーカー）宛ての差分を捨てる（戻ってきたら全体を送り直す）
+        now = time.time()
+        busy = {worker for worker, _ in self.assigned.values()}
+        for worker, last_pull in list(self.last_pull.items()):
+            if worker not in busy and now - last_pull > IDLE_TIMEOUT:
+                del self.last_pull[worker]
+                self.worker_deltas.pop(worker, None)
+
+    def handle_pull(self, worker: str) -> Dict:
+        self.last_pull[worker] = time.time()
+        self.expire_idle_workers()
+        if self.finished():
+            return {'type': 'stop'}
+        batch_id = self.next_batch()
+        if batch_id is None:
+            return {'type': 'wait', 'seconds': WAIT_SECONDS}
+        self.assigned[batch_id] = (worker, time.time())
+        player, iterations = self.batches[batch_id]
+
+        if worker not in self.worker_deltas:
+            # 初めてのワーカーには全体を送る
+            sync = {'full': True, 'regret': self.model.regret_sum, 'strategy': self.model.strategy_sum}
+        else:
+            regret_delta, strategy_delta = self.worker_deltas[worker]
+            sync = {'full': False, 'regret': regret_delta, 'strategy': strategy_delta}
+        self.worker_deltas[worker] = ({}, {})
+        return {
+            'type': 'batch',
+            'batch_id': batch_id,
+            'player': player,
+            'iterations': iterations,
+            'max_depth': self.max_depth,
+            'sync': sync,
+            'config': {'canonicalize': self.model.canonicalize, 'abstraction': self.model.abstraction},
+        }
+
+    def handle_push(self, message: Dict) -> Dict:
+        batch_id = message['batch_id']
+        if batch_id in self.completed:
+            # 割り当て直したバッチの結果が二重に届いた場合は捨てる
+            return {'type': 'ack', 'duplicate': True}
+        self.assigned.pop(batch_id, None)
+        self.completed.add(batch_id)
+
+        regret_delta, strategy_delta = message['regret'], message['strategy']
+        self.expire_idle_workers()
+        merge_tables(self.model.regret_sum, regret_delta)
+        merge_tables(self.model.strategy_sum, strategy_delta)
+        for worker, (pending_regret, pending_strategy) in self.worker_deltas.items():
+            if worker != message['worker']:
+                merge_tables(pending_regret, regret_delta)
+                merge_tables(pending_strategy, strategy_delta)
+
+        player, iterations = self.batches[batch_id]
+        self.completed_iterations += len(iterations)
+        self.utilities.extend(message['utilities'])
+        profiler = CFRProfiler()
+        profiler.merge(message['profile'])
+        record = self.model.export_profile(profiler, player, len(self.completed), len(iterations), message['elapsed'])
+        print(f"バッチ {batch_id} 完了 (worker {message['worker']}, {len(regret_delta)} 情報集合, "
+              f"Nodes/sec: {record['nodes_per_sec']:.1f}) {len(self.completed)}/{len(self.batches)}")
+
+        if self.completed_iterations - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+        return {'type': 'ack', 'duplicate': False}
+
+    def checkpoint(self):
+        name = f"{self.filename}_iter_{self.completed_iterations}.pkl"
+        self.model.save_model(name, streaming=self.streaming)
+        with open(self.progress_path, 'w') as f:
+            json.dump({
+                'checkpoint': name,
+                'completed': sorted(self.completed),
+                'completed_iterations': self.completed_iterations,
+            }, f)
+        self.last_checkpoint = self.completed_iterations
+
+    def run(self, server):
+        start_time = time.time()
+        try:
+            while not self.finished():
+                request = server.next_request()
+                if request is None:
+                    continue
+                message, respond = request
+                respond(self.handle(message))
+            if self.completed_iterations != self.last_checkpoint:
+                self.checkpoint()
+        finally:
+            server.close()
+        print(f"トレーニング完了 (総所要時間: {time.time() - start_time:.2f}秒)")
+
+
+def run_worker(client, worker_id: Optional[str] = None):
+    """バッチを受け取ってCFRを実行し、後悔・戦略の差分を返すことを、停止の指示が来るまで繰り返す"""
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    model = None
+    while True:
+        reply = client.request({'type': 'pull', 'worker': worker_id})
+        if reply is None or reply['type'] == 'stop':
+            break
+        if reply['type'] == 'wait':
+            time.sleep(reply['seconds'])
+            continue
+
+        sync = reply['sync']
+        if model is None or sync['full']:
+            model = FogShogiCFR(**reply['config'])
+            model.regret_sum = sync['regret']
+            model.strategy_sum = sync['strategy']
+        else:
+            merge_tables(model.regret_sum, sync['regret'])
+            merge_tables(model.strategy_sum, sync['strategy'])
+
+        # このバッチで加算した量だけを差分として送る
+        model.deltas = ({}, {})
+        model.profiler.reset()
+        start = time.time()
+        utilities = []
+        for iteration in reply['iterations']:
+            # キャッシュが残っていると根の値がそのまま返り、後悔・戦略が更新されないので毎回空にする
+            model.cache.clear()
+            utilities.append(model.cfr_iteration(iteration, reply['player'], reply['max_depth']))
+        regret_delta, strategy_delta = model.deltas
+        model.deltas = None
+
+        ack = client.request({
+            'type': 'push',
+            'worker': worker_id,
+            'batch_id': reply['batch_id'],
+            'regret': regret_delta,
+            'strategy': strategy_delta,
+            'utilities': [float(u) for u in utilities],
+            'profile': model.profiler.snapshot(),
+            'elapsed': time.time() - start,
+        })
+        if ack is None:
+            break
+
+
+def _worker_process(transport: str, address: str, authkey: str, worker_id: str):
+    # 起動直後はコーディネーターの待ち受けが始まっていない場合があるので少し待つ
+    time.sleep(WAIT_SECONDS)
+    run_worker(make_client(transport, address, authkey), worker_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="複数のマシン（またはプロセス）で霧将棋のCFRを学習する")
+    parser.add_argument('role', choices=['coordinator', 'worker', 'local'],
+                        help="localはコーディネーターと--workers個のワーカーを同じマシンで起動する（動作確認用）")
+    parser.add_argument('--transport', choices=['socket', 'file'], default='socket')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS,
+                        help="socketでは host:port、fileでは共有ディレクトリのパス")
+    parser.add_argument('--authkey', default=DEFAULT_AUTHKEY,
+                        help="socketの認証キー（環境変数FOG_SHOGI_AUTHKEYでも指定できる。ループバック以外のアドレスでは必須）")
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--max-depth', type=int, default=8, help="CFRの探索の深さ")
+    parser.add_argument('--alternating', action='store_true', help="先手・後手を別々のバッチとして学習する")
+    parser.add_argument('--checkpoint-interval', type=int, default=100)
+    parser.add_argument('--filename', default="fog_shogi_cfr")
+    parser.add_argument('--streaming', action='store_true', help="チェックポイントをストリーミング形式で保存する")
+    parser.add_argument('--resume', action='store_true', help="進捗ファイルがあれば最後のチェックポイントから再開する")
+    parser.add_argument('--canonicalize', action='store_true', help="左右反転した情報集合を同一視する（推論側で効くのは--bucketsと併用した場合だけ）")
+    parser.add_argument('--buckets', type=int, default=0, help="情報集合をこの数のバケットに抽象化する（0は抽象化しない）")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="localで起動するワーカー数")
+    parser.add_argument('--worker-id')
+    args = parser.parse_args()
+
+    if args.transport == 'socket':
+        try:
+            args.authkey = resolve_authkey(args.address, args.authkey)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.role == 'worker':
+        run_worker(make_client(args.transport, args.address, args.authkey), args.worker_id)
+        return
+
+    abstraction = make_abstraction(num_buckets=args.buckets) if args.buckets else None
+    model = FogShogiCFR(profile_path=f"{args.filename}_profile.jsonl", canonicalize=args.canonicalize,
+                        abstraction=abstraction)
+    players = [1, -1] if args.alternating else [BOTH_PLAYERS]
+    coordinator = Coordinator(model, args.iterations, args.batch_size, players, args.filename,
+                              args.checkpoint_interval, args.streaming, args.max_depth)
+    if args.resume:
+        try:
+            coordinator.resume()
+        except ValueError as e:
+            parser.error(str(e))
+    server = make_server(args.transport, args.address, args.authkey)
+
+    workers = []
+    if args.role == 'local':
+        # forkだと待ち受けソケットがワーカーに引き継がれ、終了後も接続が拒否されなくなるのでspawnで起動する
+        context = multiprocessing.get_context('spawn')
+        for k in range(args.workers):
+            process = context.Process(target=_worker_process,
+                                              args=(args.transport, args.address, args.authkey, f"local-{k}"))
+            process.start()
+            workers.append(process)
+    try:
+        coordinator.run(server)
+    finally:
+        for process in workers:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
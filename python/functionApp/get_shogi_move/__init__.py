@@ -1,31 +1,82 @@
+import time
+_import_started = time.perf_counter()
+
 import azure.functions as func
 import json
-import pickle
 import os
 import logging
 import random
-import numpy as np
 from typing import List, Tuple, Dict, Optional
 
-# モデルデータの読み込み
+from .abstraction import abstract_bucket
+from .search import PIECE_CODES, search_best_move, search_determinized, to_search_board
+
+# 戦略がない局面で探索に使う1リクエストあたりの持ち時間（ミリ秒）
+SEARCH_BUDGET_MS = float(os.environ.get('SHOGI_SEARCH_BUDGET_MS', '200'))
+# リクエストで持ち時間を指定された場合の上限（ミリ秒）
+SEARCH_MAX_BUDGET_MS = float(os.environ.get('SHOGI_SEARCH_MAX_BUDGET_MS', '1000'))
+# 見えないマスを補った盤面をいくつ作って探索するか（0なら視界付き盤面だけで探索する）
+SEARCH_SAMPLES = int(os.environ.get('SHOGI_SEARCH_SAMPLES', '0'))
+# リクエストでサンプル数を指定された場合の上限（補完の作業用配列がサンプル数に比例して大きくなるため）
+SEARCH_MAX_SAMPLES = int(os.environ.get('SHOGI_SEARCH_MAX_SAMPLES', '256'))
+
+# 駒の種類 -> (先手の移動方向, 後手の移動方向)
+PIECE_DIRECTIONS = {
+    "歩": (((-1, 0),), ((1, 0),)),
+    "香": (((-1, 0),), ((1, 0),)),
+    "銀": (((-1, -1), (-1, 0), (-1, 1), (1, -1), (1, 1)),) * 2,
+    "角": (((-1, -1), (-1, 1), (1, -1), (1, 1)),) * 2,
+    "飛": (((-1, 0), (1, 0), (0, -1), (0, 1)),) * 2,
+    "王": (((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)),) * 2,
+    "馬": (((-1, -1), (-1, 1), (1, -1), (1, 1), (-1, 0), (1, 0), (0, -1), (0, 1)),) * 2,
+    "龍": (((-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)),) * 2,
+}
+for _piece_type in ["金", "と", "成香", "成桂", "成銀"]:
+    PIECE_DIRECTIONS[_piece_type] = (((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)),) * 2
+# 桂馬の移動先（先手, 後手）
+KNIGHT_OFFSETS = (((-2, -1), (-2, 1)), ((2, -1), (2, 1)))
+# 1マスだけ動く駒
+STEP_PIECES = frozenset(["歩", "桂", "銀", "金", "王", "と", "成香", "成桂", "成銀"])
+# (駒の種類, プレイヤー) -> 情報集合の文字列での表現
+PIECE_STRINGS = {
+    (piece_type, player): str(code if player == "先手" else -code)
+    for piece_type, code in PIECE_CODES.items() for player in ("先手", "後手")
+}
+
+# モデルは最初のリクエストで読み込む（環境変数SHOGI_PRELOAD_MODEL=1なら読み込み時に読む）
 model_path = os.path.join(os.path.dirname(__file__), 'models', 'fog_shogi_cfr_iter_5000.pkl')
-logging.info(f"Attempting to load model from: {model_path}")
-
-# モデルファイルの存在確認と読み込み
-if os.path.exists(model_path):
-    logging.info("Model file found. Attempting to load...")
-    with open(model_path, 'rb') as f:
-        model_data = pickle.load(f)
-    logging.info("Model loaded successfully.")
-else:
-    logging.error(f"Model file not found at: {model_path}")
-    raise FileNotFoundError(f"Model file not found at: {model_path}")
+_model_data = None
+
+# コールドスタートの計測値（ミリ秒）
+cold_start = {'import_ms': None, 'model_load_ms': None, 'first_request_ms': None}
+
+def get_model_data():
+    global _model_data
+    if _model_data is None:
+        start = time.perf_counter()
+        logging.info(f"Attempting to load model from: {model_path}")
+        # モデルファイルの存在確認と読み込み
+        if not os.path.exists(model_path):
+            logging.error(f"Model file not found at: {model_path}")
+            raise FileNotFoundError(f"Model file not found at: {model_path}")
+        # pickle形式とストリーミング形式（compact_model.py --streaming の出力）のどちらも読める。後悔は推論に使わないので読み込まない
+        from .model_io import load_model_file
+        _model_data = load_model_file(model_path, load_regret=False)
+        cold_start['model_load_ms'] = (time.perf_counter() - start) * 1000
+        logging.info(f"Model loaded successfully ({cold_start['model_load_ms']:.1f} ms).")
+    return _model_data
+
+def get_cold_start_report():
+    # 読み込み時間・モデルの読み込み時間・最初のリクエストの処理時間
+    return dict(cold_start)
 
 def get_information_set(board, player):
+    # 注意: 学習側の文字列の情報集合は学習側の霧の規則で見えないマスを-1にしたバイト列なので、このキーとは一致しない。
+    # 学習したテーブルを推論で引けるのは抽象化したモデル（get_abstract_information_set）だけ
     # ボードの状態を文字列に変換
     board_string = ''.join([
         ''.join([
-            str(get_piece_value(cell['type'], cell['player'])) if cell else '0'
+            PIECE_STRINGS.get((cell['type'], cell['player']), '0') if cell else '0'
             for cell in row
         ])
         for row in board
@@ -34,13 +85,18 @@ def get_information_set(board, player):
     player_value = 1 if player == "先手" else -1
     return f"{board_string}|{player_value}"
 
+def get_abstract_information_set(board, player, hands, config):
+    # 学習側のget_abstract_information_setと同じバケット番号を求める（持ち駒が不明な場合は持ち駒なしとして扱う）
+    opponent = "後手" if player == "先手" else "先手"
+    def hand_codes(owner):
+        return {abs(get_piece_value(piece_type, owner)): count
+                for piece_type, count in ((hands or {}).get(owner) or {}).items() if get_piece_value(piece_type, owner)}
+    side = 1 if player == "先手" else -1
+    return abstract_bucket(to_search_board(board), side, hand_codes(player), hand_codes(opponent), config)
+
 def get_piece_value(piece_type, player):
     # 駒の種類に応じて数値を割り当て
-    piece_values = {
-        "歩": 1, "香": 2, "桂": 3, "銀": 4, "金": 6, "角": 5, "飛": 7, "王": 8,
-        "と": 11, "成香": 12, "成桂": 13, "成銀": 14, "馬": 15, "龍": 17
-    }
-    value = piece_values.get(piece_type, 0)
+    value = PIECE_CODES.get(piece_type, 0)
     # 後手の場合は負の値を返す
     return value if player == "先手" else -value
 
@@ -58,11 +114,77 @@ def get_average_strategy(info_set, model_data):
         uniform_prob = 1 / len(actions) if actions else 0
         return {action: uniform_prob for action in actions}
 
-def get_cpu_move(board, player, model_data=model_data):
-    # 現在の盤面の情報集合を取得
-    info_set = get_information_set(board, player)
+def mirror_action(action):
+    # 5筋を軸に左右反転した手（持ち駒を打つ手は打つ位置だけ反転する）
+    i, j, ni, nj = action[:4]
+    return (i, j if i == -1 else 8 - j, ni, 8 - nj) + tuple(action[4:])
+
+def is_mirror_smaller(board):
+    # 盤面を左右反転した方が、行優先で並べたときに辞書順で小さいかどうか（学習側と同じ基準）
+    values = [get_piece_value(cell['type'], cell['player']) if cell else 0 for row in board for cell in row]
+    mirrored = [get_piece_value(cell['type'], cell['player']) if cell else 0 for row in board for cell in reversed(row)]
+    for value, mirrored_value in zip(values, mirrored):
+        if value != mirrored_value:
+            return mirrored_value < value
+    return False
+
+def get_search_budget(requested):
+    # クライアントが指定した持ち時間をサーバー側の上限で切り詰める（正の値でなければ既定値を使う）
+    if requested is None:
+        return SEARCH_BUDGET_MS
+    budget_ms = float(requested)
+    if not budget_ms > 0:
+        return SEARCH_BUDGET_MS
+    return min(budget_ms, SEARCH_MAX_BUDGET_MS)
+
+def get_search_samples(requested):
+    # クライアントが指定したサンプル数をサーバー側の上限で切り詰める（0以下なら補完しない）
+    if requested is None:
+        return min(SEARCH_SAMPLES, SEARCH_MAX_SAMPLES)
+    return max(0, min(int(requested), SEARCH_MAX_SAMPLES))
+
+def count_captured_pieces(captured_pieces):
+    # フロントエンドの持ち駒（プレイヤーごとの駒のリスト）を駒の種類ごとの枚数にする
+    if not captured_pieces:
+        return None
+    hands = {}
+    for owner, pieces in captured_pieces.items():
+        counts = {}
+        for piece in pieces:
+            counts[piece['type']] = counts.get(piece['type'], 0) + 1
+        hands[owner] = counts
+    return hands
+
+def choose_search_move(board, player, actions, budget_ms, num_samples=0, game_id=None, hands=None):
+    # 補完した盤面の数が指定されていればそれらの上で、なければ視界付き盤面だけで探索する
+    if num_samples > 0:
+        # numpyを使うので、必要になったときに読み込む
+        from .determinize import get_determinizer
+        samples = get_determinizer(game_id).sample(board, player, num_samples, hands)
+        return search_determinized(samples, player, actions, budget_ms)
+    return search_best_move(board, player, actions, budget_ms)
+
+def get_cpu_move(board, player, model_data=None, budget_ms=SEARCH_BUDGET_MS,
+                 num_samples=SEARCH_SAMPLES, game_id=None, hands=None):
+    if model_data is None:
+        model_data = get_model_data()
+    # 左右反転を同一視して学習したモデルでは、正規化した向きの盤面で情報集合を引く
+    # （文字列の情報集合のモデルはどちらの向きでも学習側のキーと一致しないので、反転は抽象化したモデルだけで行う）
+    mirrored = bool(model_data.get('abstraction')) and model_data.get('canonical', False) and is_mirror_smaller(board)
+    lookup_board = [list(reversed(row)) for row in board] if mirrored else board
+    # 現在の盤面の情報集合を取得（抽象化して学習したモデルではバケット番号）
+    if model_data.get('abstraction'):
+        info_set = get_abstract_information_set(lookup_board, player, hands, model_data['abstraction'])
+    else:
+        info_set = get_information_set(lookup_board, player)
     # 情報集合に対する戦略を取得
-    strategy = get_average_strategy(info_set, model_data)
+    # 学習側の手は成るかどうかを含む (i, j, ni, nj, promote) なので、エンドポイントの (i, j, ni, nj) ごとにまとめる
+    # （成る・成らないの両方がある移動は確率の高い方を使う。反転した向きで引いた場合は手を元の向きに戻す）
+    strategy = {}
+    for action, probability in get_average_strategy(info_set, model_data).items():
+        move = tuple((mirror_action(action) if mirrored else action)[:4])
+        if probability > strategy.get(move, -1):
+            strategy[move] = probability
     
     # 合法手を取得
     actions = get_legal_actions(board, player)
@@ -77,8 +199,8 @@ def get_cpu_move(board, player, model_data=model_data):
             # 最も確率の高い行動を選択
             return max(valid_actions, key=lambda a: strategy.get(a, 0))
     
-    # 戦略がない場合や有効な行動がない場合はランダムな合法手を返す
-    return random.choice(actions)
+    # 戦略がない場合や有効な行動がない場合は持ち時間内で探索した手を返す
+    return choose_search_move(board, player, actions, budget_ms, num_samples, game_id, hands)
 
 def get_legal_actions(board, player):
     actions = []
@@ -95,38 +217,21 @@ def get_legal_actions(board, player):
     return actions
 
 def get_piece_moves(piece_type, i, j, player, board):
+    side = 0 if player == "先手" else 1
+    if piece_type == "桂":
+        return [(i + di, j + dj) for di, dj in KNIGHT_OFFSETS[side] if 0 <= i + di < 9 and 0 <= j + dj < 9]
+
     moves = []
-    directions = []
-    # 各駒の移動方向を設定
-    if piece_type == "歩":
-        directions = [(-1, 0)] if player == "先手" else [(1, 0)]
-    elif piece_type == "香":
-        directions = [(-1, 0)] if player == "先手" else [(1, 0)]
-    elif piece_type == "桂":
-        potential_moves = [(i - 2, j - 1), (i - 2, j + 1)] if player == "先手" else [(i + 2, j - 1), (i + 2, j + 1)]
-        return [(ni, nj) for ni, nj in potential_moves if 0 <= ni < 9 and 0 <= nj < 9]
-    elif piece_type == "銀":
-        directions = [(-1, -1), (-1, 0), (-1, 1), (1, -1), (1, 1)]
-    elif piece_type == "角":
-        directions = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
-    elif piece_type in ["金", "と", "成香", "成桂", "成銀"]:
-        directions = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)]
-    elif piece_type == "飛":
-        directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
-    elif piece_type == "王":
-        directions = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
-    elif piece_type == "馬":
-        directions = [(-1, -1), (-1, 1), (1, -1), (1, 1), (-1, 0), (1, 0), (0, -1), (0, 1)]
-    elif piece_type == "龍":
-        directions = [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
-
-    # 各方向に対して移動可能なマスを探索
+    # 各駒の移動方向を表から引き、各方向に対して移動可能なマスを探索
+    directions = PIECE_DIRECTIONS[piece_type][side] if piece_type in PIECE_DIRECTIONS else ()
+    step = piece_type in STEP_PIECES
     for di, dj in directions:
         ni, nj = i + di, j + dj
         while 0 <= ni < 9 and 0 <= nj < 9:
-            if board[ni][nj] is None or board[ni][nj]['player'] != player:
+            cell = board[ni][nj]
+            if cell is None or cell['player'] != player:
                 moves.append((ni, nj))
-            if board[ni][nj] is not None or piece_type in ["歩", "桂", "銀", "金", "王", "と", "成香", "成桂", "成銀"]:
+            if cell is not None or step:
                 break
             ni, nj = ni + di, nj + dj
 
@@ -191,12 +296,27 @@ def apply_move(board: List[List[Optional[Dict]]], move: Tuple[int, int, int, int
     return new_board
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
+    start = time.perf_counter()
+    try:
+        return handle_request(req)
+    finally:
+        if cold_start['first_request_ms'] is None:
+            cold_start['first_request_ms'] = (time.perf_counter() - start) * 1000
+            logging.info(f"Cold start: import {cold_start['import_ms']:.1f} ms, "
+                         f"model load {cold_start['model_load_ms'] or 0:.1f} ms, "
+                         f"first request {cold_start['first_request_ms']:.1f} ms")
+
+def handle_request(req: func.HttpRequest) -> func.HttpResponse:
     try:
         # リクエストボディからJSONデータを取得
         req_body = req.get_json()
         full_board = req_body.get('fullBoard')
         visible_board = req_body.get('visibleBoard')
         player = req_body.get('player')
+        budget_ms = get_search_budget(req_body.get('budgetMs'))
+        num_samples = get_search_samples(req_body.get('samples'))
+        game_id = req_body.get('gameId')
+        hands = count_captured_pieces(req_body.get('capturedPieces'))
 
         # 必要なデータが揃っているか確認
         if not full_board or not visible_board or not player:
@@ -216,8 +336,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             logging.info("Player is in check. Finding safe moves.")
             safe_moves = get_safe_moves(full_board, visible_board, player)
             if safe_moves:
-                # 安全な手からランダムに選択
-                move = random.choice(safe_moves)
+                # 安全な手の中から持ち時間内で探索して選択
+                move = choose_search_move(visible_board, player, safe_moves, budget_ms, num_samples, game_id, hands)
                 logging.info(f"Selected safe move: {move}")
             else:
                 logging.warning("No safe moves available. Player is in checkmate.")
@@ -227,7 +347,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 )
         else:
             # 通常の手を選択
-            move = get_cpu_move(visible_board, player)
+            move = get_cpu_move(visible_board, player, budget_ms=budget_ms, num_samples=num_samples,
+                                game_id=game_id, hands=hands)
         
         if move:
             logging.info(f"CPU move found: {move}")
@@ -256,4 +377,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse(
             "An unexpected error occurred",
             status_code=500
-        )
\ No newline at end of file
+        )
+
+if os.environ.get('SHOGI_PRELOAD_MODEL') == '1':
+    get_model_data()
+cold_start['import_ms'] = (time.perf_counter() - _import_started) * 1000
@@ -0,0 +1,198 @@
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import numpy as np
+
+from .search import PIECE_CODES, to_search_board
+
+# 1局で各駒が盤上・持ち駒を合わせて何枚あるか（先後合計）
+TOTAL_PIECES = {1: 18, 2: 4, 3: 4, 4: 4, 5: 2, 6: 4, 7: 2, 8: 2}
+# 成り駒 -> 元の駒
+UNPROMOTED = {1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 6: 6, 7: 7, 8: 8, 11: 1, 12: 2, 13: 3, 14: 4, 15: 5, 17: 7}
+# 行き所のない駒を置けない段数（歩・香は最奥1段、桂は2段）
+DEAD_RANKS = {1: 1, 2: 1, 3: 2}
+MAX_RESAMPLE_ROUNDS = 8
+MAX_CACHED_GAMES = 32
+
+KING_STEPS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+
+def _vision_rays(piece: int, side: int, i: int, j: int):
+    # フロントエンドのgetVisibleCellsForPieceと同じ視界（歩・桂・銀・金は駒の持ち主の向き）
+    d = -1 if side == 1 else 1
+    gold = [(d, -1), (d, 0), (d, 1), (0, -1), (0, 1), (-d, 0)]
+    steps, lines = [], []
+    if piece == 1:
+        steps = [(d, 0)]
+    elif piece == 2:
+        lines = [(d, 0)]
+    elif piece == 3:
+        steps = [(2 * d, -1), (2 * d, 1)]
+    elif piece == 4:
+        steps = [(d, -1), (d, 0), (d, 1), (-d, -1), (-d, 1)]
+    elif piece in (6, 11, 12, 13, 14):
+        steps = gold
+    elif piece == 5:
+        lines = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+    elif piece == 7:
+        lines = [(0, 1), (0, -1), (1, 0), (-1, 0)]
+    elif piece == 8:
+        steps = KING_STEPS
+    elif piece == 15:
+        lines, steps = [(1, 1), (1, -1), (-1, 1), (-1, -1)], KING_STEPS
+    elif piece == 17:
+        lines, steps = [(0, 1), (0, -1), (1, 0), (-1, 0)], KING_STEPS
+
+    rays = []
+    for di, dj in steps:
+        ni, nj = i + di, j + dj
+        if 0 <= ni < 9 and 0 <= nj < 9:
+            rays.append([ni * 9 + nj])
+    for di, dj in lines:
+        ray = []
+        ni, nj = i + di, j + dj
+        while 0 <= ni < 9 and 0 <= nj < 9:
+            ray.append(ni * 9 + nj)
+            ni, nj = ni + di, nj + dj
+        if ray:
+            rays.append(ray)
+    return rays
+
+
+# VISION_RAYS[side][piece][square]
+VISION_RAYS = {
+    side: {piece: [_vision_rays(piece, side, square // 9, square % 9) for square in range(81)]
+           for piece in set(UNPROMOTED)}
+    for side in (1, -1)
+}
+
+
+def visible_squares(values, side: int) -> np.ndarray:
+    """自分の駒と、その視界に入るマスを表す長さ81のboolを返す
+
+    視線は最初の駒で遮られ、その駒自体は見えているので、視界付き盤面だけから正確に再計算できる。
+    """
+    visible = np.zeros(81, dtype=bool)
+    for square, value in enumerate(values):
+        if value * side <= 0:
+            continue
+        visible[square] = True
+        for ray in VISION_RAYS[side][abs(value)][square]:
+            for target in ray:
+                visible[target] = True
+                if values[target] != 0:
+                    break
+    return visible
+
+
+def hidden_material(values, side: int, hands: Optional[Dict[str, Dict[str, int]]] = None) -> np.ndarray:
+    """盤上に見えておらず持ち駒でもない駒（= 見えないマスにある相手の駒）の数値を返す"""
+    remaining = dict(TOTAL_PIECES)
+    for value in values:
+        if value != 0:
+            remaining[UNPROMOTED[abs(value)]] -= 1
+    for pieces in (hands or {}).values():
+        for piece_type, count in pieces.items():
+            piece = UNPROMOTED.get(PIECE_CODES.get(piece_type, 0))
+            if piece:
+                remaining[piece] -= count
+
+    opponent = -side
+    pieces = []
+    # 価値の高い駒から並べ、マスが足りない場合は価値の低い駒を切り捨てる
+    for piece in (8, 7, 5, 6, 4, 3, 2, 1):
+        pieces.extend([piece * opponent] * max(remaining[piece], 0))
+    return np.array(pieces, dtype=np.int8)
+
+
+class Determinizer:
+    """視界付き盤面と駒数から、矛盾のない完全な盤面を一度に多数生成する
+
+    同じ対局の間はインスタンスを使い回し、同じ局面への問い合わせには前回の結果を返す。
+    """
+
+    def __init__(self, seed: Optional[int] = None):
+        self.rng = np.random.default_rng(seed)
+        self.last_key = None
+        self.last_samples = None
+
+    def sample(self, board, player: str, num_samples: int,
+               hands: Optional[Dict[str, Dict[str, int]]] = None) -> np.ndarray:
+        values = to_search_board(board)
+        side = 1 if player == "先手" else -1
+        key = (bytes(np.array(values, dtype=np.int8)), side, num_samples, repr(sorted((hands or {}).items())))
+        if key == self.last_key:
+            return self.last_samples
+
+        samples = self.sample_values(np.array(values, dtype=np.int8), side, num_samples, hands)
+        self.last_key = key
+        self.last_samples = samples
+        return samples
+
+    def sample_values(self, values: np.ndarray, side: int, num_samples: int,
+                      hands: Optional[Dict[str, Dict[str, int]]] = None) -> np.ndarray:
+        """形状 (num_samples, 81) の int8 配列を返す（正: 先手, 負: 後手）"""
+        hidden = np.flatnonzero(~visible_squares(values, side))
+        pieces = hidden_material(values, side, hands)[:len(hidden)]
+        samples = np.tile(values, (num_samples, 1))
+        if len(pieces) == 0:
+            return samples
+
+        # 行き所のない駒が置けないよう、駒ごとに置いてよいマスを決めておく
+        rows = hidden // 9
+        files = hidden % 9
+        last_rows = rows if side == -1 else 8 - rows  # 相手から見た奥からの段数
+        pawn = -side
+
+        # 歩は二歩にならないよう、相手の歩がまだない筋に1枚ずつ置く
+        board = values.reshape(9, 9)
+        free_files = ~(board == pawn).any(axis=0)
+        pawn_allowed = (last_rows >= DEAD_RANKS[1]) & free_files[files]
+        in_file = files[None, :] == np.arange(9)[:, None]  # (筋, 見えないマス)
+        pawn_files = np.flatnonzero((in_file & pawn_allowed).any(axis=1))
+        num_pawns = min(int((pieces == pawn).sum()), len(pawn_files))
+        others = pieces[pieces != pawn]
+
+        rng = self.rng
+        index = np.arange(num_samples)[:, None]
+        # 筋ごとに置くマスを1つ選び、そこから歩を置く筋を選ぶ
+        keys = np.where(pawn_allowed, rng.random((num_samples, len(hidden))), -1.0)
+        file_keys = np.where(in_file[None, :, :], keys[:, None, :], -1.0)[:, pawn_files, :]
+        file_squares = file_keys.argmax(axis=2)  # (サンプル, 歩を置ける筋)
+        chosen = rng.random((num_samples, len(pawn_files))).argsort(axis=1)[:, :num_pawns]
+        pawn_squares = np.take_along_axis(file_squares, chosen, axis=1)
+        samples[index, hidden[pawn_squares]] = pawn
+
+        if len(others) == 0:
+            return samples
+        allowed = np.array([last_rows >= DEAD_RANKS.get(abs(int(p)), 0) for p in others])
+        occupied = np.zeros((num_samples, len(hidden)), dtype=bool)
+        occupied[index, pawn_squares] = True
+
+        pending = np.arange(num_samples)
+        for attempt in range(MAX_RESAMPLE_ROUNDS):
+            # 歩を置いていない見えないマスをランダムに並べ替え、先頭から順に残りの駒を置く
+            order = np.where(occupied[pending], 2.0, rng.random((len(pending), len(hidden))))
+            order = order.argsort(axis=1)[:, :len(others)]
+            valid = allowed[np.arange(len(others)), order].all(axis=1)
+            if attempt == MAX_RESAMPLE_ROUNDS - 1:
+                valid[:] = True  # 最後まで制約を満たせなかったサンプルはそのまま使う
+            samples[pending[valid][:, None], hidden[order[valid]]] = others
+            pending = pending[~valid]
+            if len(pending) == 0:
+                break
+        return samples
+
+
+_determinizers = OrderedDict()
+
+
+def get_determinizer(game_id: Optional[str] = None) -> Determinizer:
+    # 対局ごとにDeterminizerを保持し、古い対局のものから捨てる
+    if game_id is None:
+        return Determinizer()
+    determinizer = _determinizers.pop(game_id, None) or Determinizer()
+    _determinizers[game_id] = determinizer
+    if len(_determinizers) > MAX_CACHED_GAMES:
+        _determinizers.popitem(last=False)
+    return determinizer
@@ -0,0 +1,167 @@
+# python/model_io.py と同じ内容（関数アプリは単独でデプロイされるため複製して置く。変更する場合は両方をそろえること）
+import pickle
+import struct
+import zlib
+import lzma
+import bz2
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+# 任意の圧縮ライブラリ（インストールされていれば使用する）
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# ストリーミング形式のファイル先頭に書き込むマジックバイト
+STREAM_MAGIC = b'FSCFR\x01'
+# チャンク長のフォーマット（0はファイル終端を表す）
+CHUNK_HEADER = struct.Struct('<Q')
+DEFAULT_CHUNK_SIZE = 10000
+
+Record = Tuple[str, Optional[Dict], Optional[Dict]]
+
+
+def _get_codecs() -> Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]]:
+    # 圧縮方式ごとの (圧縮関数, 展開関数)
+    codecs = {
+        'none': (lambda data: data, lambda data: data),
+        'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+        'lzma': (lzma.compress, lzma.decompress),
+        'bz2': (bz2.compress, bz2.decompress),
+    }
+    if zstandard is not None:
+        codecs['zstd'] = (
+            lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+            lambda data: zstandard.ZstdDecompressor().decompress(data),
+        )
+    if lz4_frame is not None:
+        codecs['lz4'] = (lz4_frame.compress, lz4_frame.decompress)
+    return codecs
+
+
+def get_codec(compression: str) -> Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]:
+    codecs = _get_codecs()
+    if compression not in codecs:
+        raise ValueError(f"未対応の圧縮方式です: {compression} (利用可能: {', '.join(codecs)})")
+    return codecs[compression]
+
+
+def is_stream_model(path: str) -> bool:
+    """ファイルがストリーミング形式のモデルかどうかを判定する"""
+    with open(path, 'rb') as f:
+        return f.read(len(STREAM_MAGIC)) == STREAM_MAGIC
+
+
+def iter_model_entries(regret_sum: Optional[Dict], strategy_sum: Dict) -> Iterator[Record]:
+    # 情報集合ごとのレコード (info_set, regret, strategy) を順に生成する
+    for info_set, strategy in strategy_sum.items():
+        regret = regret_sum.get(info_set) if regret_sum is not None else None
+        yield info_set, regret, strategy
+    if regret_sum is not None:
+        for info_set, regret in regret_sum.items():
+            if info_set not in strategy_sum:
+                yield info_set, regret, None
+
+
+def write_model_stream(path: str, records: Iterator[Record], compression: str = 'zlib',
+                       chunk_size: int = DEFAULT_CHUNK_SIZE, metadata: Optional[Dict] = None) -> int:
+    """レコードをチャンク単位で圧縮しながら書き出し、書き込んだレコード数を返す"""
+    compress, _ = get_codec(compression)
+    name = compression.encode('ascii')
+    header = pickle.dumps(metadata or {}, protocol=pickle.HIGHEST_PROTOCOL)
+    count = 0
+    with open(path, 'wb') as f:
+        f.write(STREAM_MAGIC)
+        f.write(bytes([len(name)]))
+        f.write(name)
+        f.write(CHUNK_HEADER.pack(len(header)))  # モデルの設定（正規化の有無など）
+        f.write(header)
+
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            count += 1
+            if len(chunk) >= chunk_size:
+                _write_chunk(f, chunk, compress)
+                chunk = []
+        if chunk:
+            _write_chunk(f, chunk, compress)
+        f.write(CHUNK_HEADER.pack(0))  # 終端
+    return count
+
+
+def _write_chunk(f, chunk, compress):
+    payload = compress(pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL))
+    f.write(CHUNK_HEADER.pack(len(payload)))
+    f.write(payload)
+
+
+def save_model_stream(path: str, regret_sum: Optional[Dict], strategy_sum: Dict,
+                      compression: str = 'zlib', chunk_size: int = DEFAULT_CHUNK_SIZE,
+                      metadata: Optional[Dict] = None) -> int:
+    """regret_sum/strategy_sumを丸ごとpickle化せずにチャンク単位で保存する"""
+    return write_model_stream(path, iter_model_entries(regret_sum, strategy_sum), compression, chunk_size, metadata)
+
+
+def _read_stream_header(f, path: str) -> Tuple[Callable[[bytes], bytes], Dict]:
+    if f.read(len(STREAM_MAGIC)) != STREAM_MAGIC:
+        raise ValueError(f"{path} はストリーミング形式のモデルではありません。")
+    name_length = f.read(1)[0]
+    compression = f.read(name_length).decode('ascii')
+    _, decompress = get_codec(compression)
+    (length,) = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+    metadata = pickle.loads(f.read(length))
+    return decompress, metadata
+
+
+def read_model_metadata(path: str) -> Dict:
+    """ストリーミング形式のモデルの設定だけを読み出す"""
+    with open(path, 'rb') as f:
+        return _read_stream_header(f, path)[1]
+
+
+def iter_model_stream(path: str) -> Iterator[Record]:
+    """ストリーミング形式のモデルからレコードを1件ずつ読み出す"""
+    with open(path, 'rb') as f:
+        decompress, _ = _read_stream_header(f, path)
+
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                raise ValueError(f"{path} が途中で切れています。")
+            (length,) = CHUNK_HEADER.unpack(header)
+            if length == 0:
+                return
+            payload = f.read(length)
+            if len(payload) < length:
+                raise ValueError(f"{path} が途中で切れています。")
+            yield from pickle.loads(decompress(payload))
+
+
+def load_model_stream(path: str, load_regret: bool = True) -> Dict[str, Dict]:
+    """ストリーミング形式のモデルを読み込み、pickle形式と同じ辞書を返す"""
+    metadata = read_model_metadata(path)
+    regret_sum = {}
+    strategy_sum = {}
+    for info_set, regret, strategy in iter_model_stream(path):
+        if strategy is not None:
+            strategy_sum[info_set] = strategy
+        if load_regret and regret is not None:
+            regret_sum[info_set] = regret
+    return {**metadata, 'regret_sum': regret_sum, 'strategy_sum': strategy_sum}
+
+
+def load_model_file(path: str, load_regret: bool = True) -> Dict[str, Dict]:
+    """pickle形式・ストリーミング形式のどちらのモデルファイルも読み込む"""
+    if is_stream_model(path):
+        return load_model_stream(path, load_regret)
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    if not load_regret:
+        data['regret_sum'] = {}
+    return data
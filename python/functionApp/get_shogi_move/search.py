@@ -0,0 +1,222 @@
+import time
+from typing import List, Optional, Tuple
+
+# 駒の種類 -> 数値（get_piece_valueと同じ割り当て）
+PIECE_CODES = {
+    "歩": 1, "香": 2, "桂": 3, "銀": 4, "金": 6, "角": 5, "飛": 7, "王": 8,
+    "と": 11, "成香": 12, "成桂": 13, "成銀": 14, "馬": 15, "龍": 17
+}
+# 評価に使う駒の価値（学習側のevaluate_positionと同じ値）
+PIECE_VALUES = [0, 100, 400, 450, 500, 800, 600, 900, 15000, 0, 0, 200, 500, 550, 600, 1000, 0, 1100]
+MATE_SCORE = 1000000
+INFINITY = 10 ** 9
+
+ORTHOGONAL = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+DIAGONAL = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+GOLD = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)]
+SILVER = [(-1, -1), (-1, 0), (-1, 1), (1, -1), (1, 1)]
+
+
+def _piece_directions(piece: int, side: int) -> Tuple[List[Tuple[int, int]], bool]:
+    # get_piece_movesと同じ移動方向（歩・香・桂以外は手番によらない）と、走り駒かどうか
+    forward = (-1, 0) if side == 1 else (1, 0)
+    if piece == 1:
+        return [forward], False
+    if piece == 2:
+        return [forward], True
+    if piece == 4:
+        return SILVER, False
+    if piece == 5:
+        return DIAGONAL, True
+    if piece == 7:
+        return ORTHOGONAL, True
+    if piece == 8:
+        return ORTHOGONAL + DIAGONAL, False
+    if piece in (6, 11, 12, 13, 14):
+        return GOLD, False
+    if piece in (15, 17):
+        return DIAGONAL + ORTHOGONAL, True
+    return [], False
+
+
+def _build_rays():
+    # RAYS[side][piece][square] = そのマスから各方向にたどるマスのリスト
+    rays = {}
+    for side in (1, -1):
+        rays[side] = {}
+        for piece in sorted(set(PIECE_CODES.values())):
+            table = []
+            for square in range(81):
+                i, j = divmod(square, 9)
+                square_rays = []
+                if piece == 3:
+                    ni = i - 2 if side == 1 else i + 2
+                    square_rays = [[ni * 9 + nj] for nj in (j - 1, j + 1) if 0 <= ni < 9 and 0 <= nj < 9]
+                else:
+                    directions, sliding = _piece_directions(piece, side)
+                    for di, dj in directions:
+                        ray = []
+                        ni, nj = i + di, j + dj
+                        while 0 <= ni < 9 and 0 <= nj < 9:
+                            ray.append(ni * 9 + nj)
+                            if not sliding:
+                                break
+                            ni, nj = ni + di, nj + dj
+                        if ray:
+                            square_rays.append(ray)
+                table.append(square_rays)
+            rays[side][piece] = table
+    return rays
+
+
+# モジュール読み込み時に一度だけ作る移動先の表
+RAYS = _build_rays()
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def to_search_board(board) -> List[int]:
+    # エンドポイントの盤面を81要素の数値リストに変換する（正: 先手, 負: 後手）
+    values = []
+    for row in board:
+        for cell in row:
+            if cell is None:
+                values.append(0)
+            else:
+                code = PIECE_CODES.get(cell['type'], 0)
+                values.append(code if cell['player'] == "先手" else -code)
+    return values
+
+
+def evaluate(board: List[int], side: int) -> int:
+    # 手番側から見た駒得
+    score = 0
+    for value in board:
+        if value > 0:
+            score += PIECE_VALUES[value]
+        elif value < 0:
+            score -= PIECE_VALUES[-value]
+    return score * side
+
+
+def generate_moves(board: List[int], side: int) -> List[Tuple[int, int]]:
+    # get_legal_actionsと同じ疑似合法手を、駒を取る手（価値の高い駒から）を先に並べて返す
+    captures = []
+    quiet = []
+    side_rays = RAYS[side]
+    for square, value in enumerate(board):
+        if value * side <= 0:
+            continue
+        for ray in side_rays[abs(value)][square]:
+            for target in ray:
+                occupant = board[target]
+                if occupant == 0:
+                    quiet.append((square, target))
+                    continue
+                if occupant * side < 0:
+                    captures.append((PIECE_VALUES[abs(occupant)], square, target))
+                break
+    captures.sort(reverse=True)
+    return [(square, target) for _, square, target in captures] + quiet
+
+
+class Searcher:
+    """反復深化つきのアルファベータ探索（制限時間を過ぎると直前に読み切った深さの最善手を返す）"""
+
+    def __init__(self, budget_ms: float, max_depth: int = 8):
+        self.deadline = time.perf_counter() + budget_ms / 1000.0
+        self.max_depth = max_depth
+        self.nodes = 0
+        self.completed_depth = 0
+
+    def search(self, board, player: str, actions: List[Tuple[int, int, int, int]]) -> Optional[Tuple[int, int, int, int]]:
+        if not actions:
+            return None
+        side = 1 if player == "先手" else -1
+        return self.search_values(to_search_board(board), side, actions)
+
+    def search_values(self, values: List[int], side: int, actions: List[Tuple[int, int, int, int]]):
+        # ルートでは呼び出し側の合法手だけを読む（駒を取る手を先に）
+        root_moves = sorted(actions, key=lambda a: -PIECE_VALUES[abs(values[a[2] * 9 + a[3]])])
+        best_move = root_moves[0]
+        for depth in range(1, self.max_depth + 1):
+            try:
+                best_move = self.search_root(values, side, root_moves, depth)
+            except SearchTimeout:
+                break
+            self.completed_depth = depth
+            # 前の深さの最善手から読む
+            root_moves.remove(best_move)
+            root_moves.insert(0, best_move)
+        return best_move
+
+    def search_root(self, board: List[int], side: int, moves, depth: int):
+        alpha = -INFINITY
+        best_move = moves[0]
+        for move in moves:
+            i, j, ni, nj = move[:4]
+            score = self.play(board, side, i * 9 + j, ni * 9 + nj, depth, -INFINITY, -alpha)
+            if score > alpha:
+                alpha = score
+                best_move = move
+        return best_move
+
+    def play(self, board: List[int], side: int, source: int, target: int, depth: int, alpha: int, beta: int) -> int:
+        # 手を指して相手側の探索を行い、手番側から見た評価値を返す
+        captured = board[target]
+        if abs(captured) == 8:
+            return MATE_SCORE + depth  # 玉を取る手（早く取るほど高い評価）
+        board[target] = board[source]
+        board[source] = 0
+        try:
+            return -self.negamax(board, -side, depth - 1, alpha, beta)
+        finally:
+            board[source] = board[target]
+            board[target] = captured
+
+    def negamax(self, board: List[int], side: int, depth: int, alpha: int, beta: int) -> int:
+        self.nodes += 1
+        if self.nodes & 255 == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+        if depth == 0:
+            return evaluate(board, side)
+
+        moves = generate_moves(board, side)
+        if not moves:
+            return evaluate(board, side)
+        best = -INFINITY
+        for source, target in moves:
+            score = self.play(board, side, source, target, depth, -beta, -alpha)
+            if score > best:
+                best = score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+        return best
+
+
+def search_best_move(board, player: str, actions: List[Tuple[int, int, int, int]], budget_ms: float,
+                     max_depth: int = 8) -> Optional[Tuple[int, int, int, int]]:
+    """制限時間内で探索し、actionsの中から最善と判断した手を返す"""
+    return Searcher(budget_ms, max_depth).search(board, player, actions)
+
+
+def search_determinized(samples, player: str, actions: List[Tuple[int, int, int, int]], budget_ms: float,
+                        max_depth: int = 8) -> Optional[Tuple[int, int, int, int]]:
+    """見えないマスを補った複数の盤面それぞれで探索し、最善手として選ばれた回数が最も多い手を返す"""
+    if not actions:
+        return None
+    side = 1 if player == "先手" else -1
+    votes = {}
+    deadline = time.perf_counter() + budget_ms / 1000.0
+    for k, values in enumerate(samples):
+        # 残り時間を残りのサンプル数で等分する（時間を使い切ったら、それまでに探索したサンプルの投票で決める）
+        remaining_ms = (deadline - time.perf_counter()) * 1000.0
+        if remaining_ms <= 0 and votes:
+            break
+        move = Searcher(remaining_ms / (len(samples) - k), max_depth).search_values(values.tolist(), side, actions)
+        votes[move] = votes.get(move, 0) + 1
+    return max(actions, key=lambda a: votes.get(a, 0))
@@ -0,0 +1,312 @@
+import argparse
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from training import FogShogiState
+from benchmark import POSITION_CORPUS, build_position
+
+Action = Tuple[int, int, int, int, bool]
+MoveGenerator = Callable[[FogShogiState], List[Action]]
+
+# 1マスだけ動く駒
+STEP_PIECES = (1, 3, 4, 6, 8, 11, 12, 13, 14)
+PROMOTABLE_PIECES = (1, 2, 3, 4, 5, 7)
+PROMOTION_ZONE = {1: (0, 1, 2), -1: (6, 7, 8)}
+PIECE_DIRECTIONS = {
+    4: [(-1, -1), (-1, 0), (-1, 1), (1, -1), (1, 1)],
+    5: [(-1, -1), (-1, 1), (1, -1), (1, 1)],
+    6: [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)],
+    7: [(-1, 0), (1, 0), (0, -1), (0, 1)],
+    8: [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)],
+    11: [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)],
+    12: [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)],
+    13: [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)],
+    14: [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)],
+    15: [(-1, -1), (-1, 1), (1, -1), (1, 1), (-1, 0), (1, 0), (0, -1), (0, 1)],
+    17: [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)],
+}
+
+
+# ---------------------------------------------------------------------------
+# 参照実装
+# FogShogiStateの最適化前の合法手生成をそのまま盤面配列に対して書き直したもの。
+# 最適化した実装とノード単位で比較するための基準として使うので、
+# 挙動（駒の向きを手番で決めるなどの癖も含めて）を変えないこと。
+# ---------------------------------------------------------------------------
+
+def reference_piece_moves(board: np.ndarray, piece: int, i: int, j: int, turn: int) -> List[Tuple[int, int]]:
+    if piece == 3:
+        potential_moves = [(i - 2 * turn, j - 1), (i - 2 * turn, j + 1)]
+        return [(ni, nj) for ni, nj in potential_moves if 0 <= ni < 9 and 0 <= nj < 9]
+    if piece in (1, 2):
+        directions = [(-1, 0)] if turn == 1 else [(1, 0)]
+    else:
+        directions = PIECE_DIRECTIONS.get(piece, [])
+
+    moves = []
+    for di, dj in directions:
+        ni, nj = i + di, j + dj
+        while 0 <= ni < 9 and 0 <= nj < 9:
+            moves.append((ni, nj))
+            if board[ni, nj] != 0 or piece in STEP_PIECES:
+                break
+            ni, nj = ni + di, nj + dj
+    return moves
+
+
+def reference_is_visible(board: np.ndarray, i: int, j: int, player: int, turn: int) -> bool:
+    for pi in range(9):
+        for pj in range(9):
+            if board[pi, pj] * player > 0:
+                for mi, mj in reference_piece_moves(board, abs(board[pi, pj]), pi, pj, turn):
+                    if (mi, mj) == (i, j):
+                        return True
+                    if board[mi, mj] != 0:
+                        break
+    return False
+
+
+def reference_find_king(board: np.ndarray, player: int) -> Optional[Tuple[int, int]]:
+    for i in range(9):
+        for j in range(9):
+            if board[i, j] == 8 * player:
+                return (i, j)
+    return None
+
+
+def reference_is_square_attacked(board: np.ndarray, i: int, j: int, attacker: int, turn: int) -> bool:
+    for ai in range(9):
+        for aj in range(9):
+            if board[ai, aj] * attacker > 0:
+                if (i, j) in reference_piece_moves(board, abs(board[ai, aj]), ai, aj, turn):
+                    return True
+    return False
+
+
+def reference_is_checkmate(board: np.ndarray, player: int, turn: int) -> bool:
+    king_pos = reference_find_king(board, player)
+    if king_pos is None:
+        return False
+    ki, kj = king_pos
+    for di in (-1, 0, 1):
+        for dj in (-1, 0, 1):
+            if di == 0 and dj == 0:
+                continue
+            ni, nj = ki + di, kj + dj
+            if 0 <= ni < 9 and 0 <= nj < 9 and board[ni, nj] * player <= 0:
+                if not reference_is_square_attacked(board, ni, nj, -player, turn):
+                    return False
+
+    for i in range(9):
+        for j in range(9):
+            if board[i, j] * player > 0:
+                for mi, mj in reference_piece_moves(board, abs(board[i, j]), i, j, turn):
+                    if board[mi, mj] * player <= 0:
+                        original_piece = board[mi, mj]
+                        board[mi, mj] = board[i, j]
+                        board[i, j] = 0
+                        is_safe = not reference_is_square_attacked(board, ki, kj, -player, turn)
+                        board[i, j] = board[mi, mj]
+                        board[mi, mj] = original_piece
+                        if is_safe:
+                            return False
+    return True
+
+
+def reference_legal_actions(state: FogShogiState) -> List[Action]:
+    """最適化前のFogShogiState.get_legal_actionsと同じ手を生成する参照実装"""
+    board = np.array(state.board, dtype=int)
+    turn = state.turn
+    hand = state.captured_pieces[turn]
+
+    actions = []
+    for i in range(9):
+        for j in range(9):
+            if board[i, j] * turn > 0:
+                piece = abs(board[i, j])
+                for ni, nj in reference_piece_moves(board, piece, i, j, turn):
+                    if board[ni, nj] * turn <= 0:
+                        if piece in PROMOTABLE_PIECES and (i in PROMOTION_ZONE[turn] or ni in PROMOTION_ZONE[turn]):
+                            actions.append((i, j, ni, nj, True))
+                        actions.append((i, j, ni, nj, False))
+
+    for piece, count in hand.items():
+        if count <= 0:
+            continue
+        for i in range(9):
+            for j in range(9):
+                if board[i, j] != 0 or not reference_is_visible(board, i, j, turn, turn):
+                    continue
+                if piece == 1 and not 0 < i < 8:
+                    continue
+                if piece == 1 and any(board[r, j] * turn == 1 for r in range(9)):
+                    continue  # 二歩
+                if piece == 1 and _reference_is_pawn_drop_mate(board, i, j, turn):
+                    continue  # 打ち歩詰め
+                actions.append((-1, piece, i, j, False))
+
+    legal_actions = []
+    for action in actions:
+        new_board = reference_apply_board(board, action, turn)
+        king_pos = reference_find_king(new_board, turn)
+        # 適用後は手番が相手に移るので、駒の向きは相手の手番で判定される
+        if king_pos is None or not reference_is_square_attacked(new_board, king_pos[0], king_pos[1], -turn, -turn):
+            legal_actions.append(action)
+    return legal_actions
+
+
+def _reference_is_pawn_drop_mate(board: np.ndarray, i: int, j: int, turn: int) -> bool:
+    king_pos = reference_find_king(board, -turn)
+    if king_pos is None:
+        return False
+    ki, kj = king_pos
+    if abs(ki - i) > 1 or abs(kj - j) > 1:
+        return False
+    board[i, j] = turn
+    is_mate = reference_is_checkmate(board, -turn, turn)
+    board[i, j] = 0
+    return is_mate
+
+
+def reference_apply_board(board: np.ndarray, action: Action, turn: int) -> np.ndarray:
+    new_board = board.copy()
+    i, j, ni, nj, promote = action
+    if i == -1:
+        new_board[ni, nj] = j * turn
+    else:
+        if promote:
+            new_board[ni, nj] = (abs(board[i, j]) + 10) * turn
+        else:
+            new_board[ni, nj] = board[i, j]
+        new_board[i, j] = 0
+    return new_board
+
+
+# ---------------------------------------------------------------------------
+# perft
+# ---------------------------------------------------------------------------
+
+MOVE_GENERATORS: Dict[str, MoveGenerator] = {
+    'state': lambda state: state.get_legal_actions(),
+    'reference': reference_legal_actions,
+}
+
+# 打ち歩詰め・二歩・成りを含む検証用の局面（{(段, 筋): 駒}, 手番, 持ち駒）
+PERFT_POSITIONS = {
+    'pawn_drop_mate': ({(0, 0): -8, (2, 0): 6, (2, 1): 3, (1, 2): 4, (8, 8): 8}, 1, {1: {1: 1}, -1: {}}),
+    'two_pawns': ({(0, 4): -8, (8, 4): 8, (6, 0): 1, (6, 3): 1, (2, 8): -1, (5, 4): 7},
+                  1, {1: {1: 1, 6: 1}, -1: {1: 1}}),
+    'promotion': ({(0, 4): -8, (8, 4): 8, (3, 2): 1, (3, 6): 2, (4, 0): 5, (2, 8): 7, (4, 5): 3, (7, 1): -4},
+                  1, {1: {}, -1: {4: 1}}),
+}
+
+
+def make_position(pieces: Dict[Tuple[int, int], int], turn: int, hands: Dict[int, Dict[int, int]]) -> FogShogiState:
+    state = FogShogiState()
+    state.board = np.zeros((9, 9), dtype=np.int8)
+    for (i, j), piece in pieces.items():
+        state.board[i, j] = piece
+    state.turn = turn
+    state.captured_pieces = {player: dict(hands.get(player, {})) for player in (1, -1)}
+    state.update_fog()
+    state.reset_history()
+    return state
+
+
+def load_position(name: str) -> FogShogiState:
+    if name in PERFT_POSITIONS:
+        return make_position(*PERFT_POSITIONS[name])
+    for corpus_name, seed, plies, prefer_captures in POSITION_CORPUS:
+        if corpus_name == name:
+            return build_position(seed, plies, prefer_captures)
+    raise ValueError(f"未知の局面です: {name}")
+
+
+def position_names() -> List[str]:
+    return [name for name, _, _, _ in POSITION_CORPUS] + list(PERFT_POSITIONS)
+
+
+def perft(state: FogShogiState, depth: int, generator: MoveGenerator) -> int:
+    """depth手先までの末端ノード数を数える"""
+    if depth == 0:
+        return 1
+    actions = generator(state)
+    if depth == 1:
+        return len(actions)
+    nodes = 0
+    for action in actions:
+        child = state.copy()
+        child.apply_action(action)
+        nodes += perft(child, depth - 1, generator)
+    return nodes
+
+
+class Divergence(Exception):
+    def __init__(self, state: FogShogiState, path: List[Action], missing: List[Action], extra: List[Action]):
+        super().__init__("move generators diverged")
+        self.state = state
+        self.path = path
+        self.missing = missing
+        self.extra = extra
+
+    def describe(self, name_a: str, name_b: str) -> str:
+        lines = [f"手順: {self.path}", f"手番: {self.state.turn}", f"持ち駒: {self.state.captured_pieces}", "盤面:"]
+        lines.extend(' '.join(f"{int(v):3d}" for v in row) for row in self.state.board)
+        lines.append(f"{name_b}にのみある手: {self.missing}")
+        lines.append(f"{name_a}にのみある手: {self.extra}")
+        return "\n".join(lines)
+
+
+def perft_compare(state: FogShogiState, depth: int, generator_a: MoveGenerator, generator_b: MoveGenerator,
+                  path: Optional[List[Action]] = None) -> int:
+    """2つの合法手生成器でノードごとに手を比較しながらperftを行う。最初の不一致でDivergenceを送出する"""
+    path = path or []
+    if depth == 0:
+        return 1
+    actions_a = generator_a(state)
+    actions_b = generator_b(state)
+    counter_a, counter_b = Counter(actions_a), Counter(actions_b)
+    if counter_a != counter_b:
+        raise Divergence(state, path, sorted((counter_b - counter_a).elements()), sorted((counter_a - counter_b).elements()))
+    if depth == 1:
+        return len(actions_a)
+    nodes = 0
+    for action in actions_a:
+        child = state.copy()
+        child.apply_action(action)
+        nodes += perft_compare(child, depth - 1, generator_a, generator_b, path + [action])
+    return nodes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="霧将棋の合法手生成のperft")
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--position', action='append', choices=position_names(),
+                        help="対象の局面（複数指定可、省略時は全局面）")
+    parser.add_argument('--backend', default='state', choices=list(MOVE_GENERATORS))
+    parser.add_argument('--compare', choices=list(MOVE_GENERATORS), help="ノード単位で比較する合法手生成器")
+    args = parser.parse_args()
+
+    generator = MOVE_GENERATORS[args.backend]
+    for name in args.position or position_names():
+        state = load_position(name)
+        for depth in range(1, args.depth + 1):
+            start = time.perf_counter()
+            if args.compare:
+                try:
+                    nodes = perft_compare(state, depth, generator, MOVE_GENERATORS[args.compare])
+                except Divergence as divergence:
+                    print(f"{name} depth {depth}: {args.backend} と {args.compare} が一致しません")
+                    print(divergence.describe(args.backend, args.compare))
+                    raise SystemExit(1)
+            else:
+                nodes = perft(state, depth, generator)
+            elapsed = time.perf_counter() - start
+            print(f"{name} depth {depth}: {nodes} nodes, {elapsed:.2f}s, {nodes / elapsed if elapsed > 0 else 0:.1f} nodes/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
-import pickle
 import random
 from typing import List, Dict, Optional, Tuple
-from functionApp.get_shogi_move import get_cpu_move, is_king_in_check, apply_move, get_piece_moves
+from functionApp.get_shogi_move import get_cpu_move, is_king_in_check, apply_move, get_piece_moves, get_piece_value
+from model_io import load_model_file
+from zobrist import TURN_KEY, piece_key
+
+SENNICHITE_COUNT = 4  # 同一局面がこの回数現れたら千日手（引き分け）
 
 def load_model(model_path: str):
-    with open(model_path, 'rb') as f:
-        return pickle.load(f)
+    # 対戦では戦略のみ使うので、regret_sumは読み込まない
+    return load_model_file(model_path, load_regret=False)
 
 def initialize_board() -> List[List[Optional[Dict]]]:
     board = [[None for _ in range(9)] for _ in range(9)]
@@ -66,10 +69,25 @@ def print_board(board: List[List[Optional[Dict]]]):
         print("|")
     print(" +-----------------+")
 
+def square_key(cell: Optional[Dict], i: int, j: int) -> int:
+    # マスの駒に対応するZobristキー（空きマスは0）
+    if cell is None:
+        return 0
+    return piece_key(get_piece_value(cell['type'], cell['player']), i, j)
+
+def board_hash(board: List[List[Optional[Dict]]]) -> int:
+    h = 0
+    for i in range(9):
+        for j in range(9):
+            h ^= square_key(board[i][j], i, j)
+    return h
+
 def simulate_game(model_data_a, model_data_b):
     board = initialize_board()
     current_player = "先手"
     move_count = 0
+    position_hash = board_hash(board)
+    position_counts = {position_hash: 1}
     
     while True:
         print(f"\nMove {move_count + 1}:")
@@ -84,6 +102,9 @@ def simulate_game(model_data_a, model_data_b):
             print(f"{current_player}の有効な手がありません。")
             return "後手" if current_player == "先手" else "先手"
         
+        # 動いたマスの分だけハッシュ値を差分更新する
+        i, j, ni, nj = move
+        position_hash ^= square_key(board[i][j], i, j) ^ square_key(board[ni][nj], ni, nj) ^ square_key(board[i][j], ni, nj) ^ TURN_KEY
         board = apply_move(board, move, current_player)
         
         # 移動の表示を修正
@@ -104,6 +125,11 @@ def simulate_game(model_data_a, model_data_b):
         
         current_player = "後手" if current_player == "先手" else "先手"
         move_count += 1
+
+        position_counts[position_hash] = position_counts.get(position_hash, 0) + 1
+        if position_counts[position_hash] >= SENNICHITE_COUNT:
+            print("千日手です。引き分けです。")
+            return None
         
         if move_count >= 300:  # 300手で引き分け
             print("300手に達しました。引き分けです。")
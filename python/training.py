@@ -10,23 +10,73 @@ import random
 import numpy as np
 from typing import Dict, List, Tuple, Set, Optional
 import os
+import json
 import pickle
 from tqdm import tqdm
 import psutil
+from abstraction import abstract_bucket
+from model_io import save_model_stream, load_model_file
+from zobrist import TURN_KEY, board_hash, hand_key, piece_key
+
+# 利きの逆算に使う、駒ごとの移動方向（歩・香は手番で向きが変わるので別に扱う）
+ATTACK_DIRECTIONS = {
+    4: {(-1, -1), (-1, 0), (-1, 1), (1, -1), (1, 1)},
+    5: {(-1, -1), (-1, 1), (1, -1), (1, 1)},
+    6: {(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)},
+    7: {(-1, 0), (1, 0), (0, -1), (0, 1)},
+    8: {(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)},
+    11: {(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)},
+    12: {(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)},
+    13: {(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)},
+    14: {(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)},
+    15: {(-1, -1), (-1, 1), (1, -1), (1, 1), (-1, 0), (1, 0), (0, -1), (0, 1)},
+    17: {(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)},
+}
+STEP_PIECES = (1, 3, 4, 6, 8, 11, 12, 13, 14)  # 1マスだけ動く駒
+# 同一局面がこの回数現れたら千日手（引き分け）。成立には12手以上かかり、学習の走査は毎回初期局面から
+# max_depth（8以下）手までしか読まないので、学習中には成立しない（sim.pyの対局などで使う）
+SENNICHITE_COUNT = 4
+RAY_DIRECTIONS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+NUM_PIECE_TYPES = 18  # 持ち駒の配列の大きさ（駒の値0〜17）
+HAND_OFFSET = {1: 0, -1: NUM_PIECE_TYPES}  # 持ち駒の配列での各プレイヤーの開始位置
+ALL_SQUARES = (1 << 81) - 1  # 盤面全体のビットマスク（ビット i * 9 + j がマス (i, j)）
+BOTH_PLAYERS = 0  # cfr_iteration / parallel_cfr で先手・後手を1回の走査で同時に更新する指定
+PLAYER_INDEX = {1: 0, -1: 1}  # 到達確率・ユーティリティの組での各プレイヤーの位置
+
+def mirror_action(action: Tuple[int, int, int, int, bool]) -> Tuple[int, int, int, int, bool]:
+    # 5筋を軸に左右反転した手（持ち駒を打つ手は打つ位置だけ反転する）
+    i, j, ni, nj, promote = action
+    return (i, j if i == -1 else 8 - j, ni, 8 - nj, promote)
+
+def is_mirror_smaller(values: np.ndarray) -> bool:
+    # 盤面（9x9）を左右反転した方が、行優先で並べたときに辞書順で小さいかどうか
+    flat = values.ravel()
+    mirrored = values[:, ::-1].ravel()
+    diff = np.flatnonzero(flat != mirrored)
+    return diff.size > 0 and mirrored[diff[0]] < flat[diff[0]]
 
 class FogShogiState:
+    # 探索中に大量に複製されるので、属性は__slots__で固定してコンパクトに保つ
+    __slots__ = ('board', 'turn', 'hands', 'hidden_bits', 'in_check', 'attack_map', 'king_pos',
+                 'zobrist_hash', 'position_counts')
+    promotion_zone = {1: [0, 1, 2], -1: [6, 7, 8]}  # 成れる領域
+
     def __init__(self):
         # 9x9の盤面を初期化（0: 空、正: 先手の駒、負: 後手の駒）
-        self.board = np.zeros((9, 9), dtype=int)
+        self.board = np.zeros((9, 9), dtype=np.int8)
         self.turn = 1  # 1: 先手, -1: 後手
-        self.hidden_info = {1: set(), -1: set()}  # 各プレイヤーに見えない駒の位置
-        self.captured_pieces = {1: {}, -1: {}} # 持ち駒を管理する辞書
-        self.promotion_zone = {1: [0, 1, 2], -1: [6, 7, 8]}  # 成れる領域
+        self.hands = bytearray(2 * NUM_PIECE_TYPES)  # 持ち駒の枚数（HAND_OFFSET[プレイヤー] + 駒の値）
+        self.hidden_bits = {1: 0, -1: 0}  # 各プレイヤーに見えないマスのビットマスク
         self.in_check = False  # プレイヤーが王手されているかどうかを示すフラグ
+        self.attack_map = {1: np.zeros((9, 9), dtype=np.int8), -1: np.zeros((9, 9), dtype=np.int8)}  # 各プレイヤーの利きの数
+        self.king_pos = {1: None, -1: None}  # 各プレイヤーの玉の位置
 
         # 初期配置（フル配置）
         self.initial_setup()
 
+        # 局面のハッシュ値と出現回数（千日手の判定用）
+        self.reset_history()
+
         # 霧の効果を適用
         self.update_fog()
 
@@ -43,15 +93,69 @@ class FogShogiState:
         self.board[7, 7] = 7  # 飛車
         self.board[6] = 1  # 歩
 
+    @property
+    def captured_pieces(self) -> Dict[int, Dict[int, int]]:
+        # 持ち駒を {プレイヤー: {駒: 枚数}} の辞書で返す（読み取り用。変更はhandsに対して行う）
+        return {player: self.get_hand(player) for player in [1, -1]}
+
+    @captured_pieces.setter
+    def captured_pieces(self, captured_pieces: Dict[int, Dict[int, int]]):
+        self.hands = bytearray(2 * NUM_PIECE_TYPES)
+        for player, pieces in captured_pieces.items():
+            for piece, count in pieces.items():
+                self.hands[HAND_OFFSET[player] + piece] = count
+
+    def get_hand(self, player: int) -> Dict[int, int]:
+        offset = HAND_OFFSET[player]
+        return {piece: self.hands[offset + piece] for piece in range(NUM_PIECE_TYPES) if self.hands[offset + piece] > 0}
+
+    @property
+    def hidden_info(self) -> Dict[int, Set[Tuple[int, int]]]:
+        # 各プレイヤーに見えないマスの集合（読み取り用。探索中はis_hiddenを使う）
+        return {player: {(i, j) for i in range(9) for j in range(9) if self.is_hidden(i, j, player)} for player in [1, -1]}
+
+    def is_hidden(self, i: int, j: int, player: int) -> bool:
+        return (self.hidden_bits[player] >> (i * 9 + j)) & 1 == 1
+
+    def get_hidden_mask(self, player: int) -> np.ndarray:
+        # 見えないマスを9x9のbool配列で返す
+        bits = np.frombuffer(self.hidden_bits[player].to_bytes(11, 'little'), dtype=np.uint8)
+        return np.unpackbits(bits, bitorder='little')[:81].reshape(9, 9).astype(bool)
+
+    def reset_history(self):
+        # 盤面からハッシュ値を計算し直し、局面の履歴を現在の局面だけにする
+        self.zobrist_hash = self.compute_zobrist_hash()
+        self.position_counts = {self.zobrist_hash: 1}
+
+    def compute_zobrist_hash(self) -> int:
+        return board_hash(self.board, self.turn, self.captured_pieces)
+
+    def is_repetition(self) -> bool:
+        # 千日手（同一局面の繰り返し）になったかどうか
+        return self.position_counts.get(self.zobrist_hash, 0) >= SENNICHITE_COUNT
+
+    def copy(self) -> 'FogShogiState':
+        # 初期配置や霧の計算を行わずに状態を複製する
+        new_state = FogShogiState.__new__(FogShogiState)
+        new_state.board = self.board.copy()
+        new_state.turn = self.turn
+        new_state.hands = self.hands[:]
+        # 以下はupdate_fogで辞書ごと置き換えるので共有してよい
+        new_state.hidden_bits = self.hidden_bits
+        new_state.in_check = self.in_check
+        new_state.attack_map = self.attack_map
+        new_state.king_pos = self.king_pos
+        new_state.zobrist_hash = self.zobrist_hash
+        new_state.position_counts = dict(self.position_counts)
+        return new_state
+
     def update_fog(self):
-        # 霧の効果を更新する
-        self.hidden_info = {1: set(), -1: set()}
-        for i in range(9):
-            for j in range(9):
-                if not self.is_visible(i, j, 1):
-                    self.hidden_info[1].add((i, j))
-                if not self.is_visible(i, j, -1):
-                    self.hidden_info[-1].add((i, j))
+        # 霧の効果を更新する（同じ走査で利きの数と玉の位置も更新する）
+        hidden_bits, attack_map, king_pos = {}, {}, {}
+        for player in [1, -1]:
+            visible, attack_map[player], king_pos[player] = self.scan_pieces(player)
+            hidden_bits[player] = ALL_SQUARES & ~visible
+        self.hidden_bits, self.attack_map, self.king_pos = hidden_bits, attack_map, king_pos
         self.in_check = self.is_in_check(self.turn)  # 現在のプレイヤーが王手されているかを更新
 
     def is_visible(self, i: int, j: int, player: int) -> bool:
@@ -67,6 +171,27 @@ class FogShogiState:
 
         return False
     
+    def scan_pieces(self, player: int) -> Tuple[int, np.ndarray, Optional[Tuple[int, int]]]:
+        # プレイヤーの駒を1回走査し、見えるマスのビットマスク（is_visibleを全マスに適用した結果と同じ）、
+        # マスごとの利きの数（is_square_attackedと同じ判定）、玉の位置を求める
+        visible = 0
+        attacks = np.zeros((9, 9), dtype=np.int8)
+        king_pos = None
+        for pi in range(9):
+            for pj in range(9):
+                if self.board[pi, pj] * player > 0:
+                    piece = abs(self.board[pi, pj])
+                    if piece == 8 and king_pos is None:
+                        king_pos = (pi, pj)
+                    seen = True
+                    for mi, mj in self.get_piece_moves(piece, pi, pj):
+                        attacks[mi, mj] += 1
+                        if seen:
+                            visible |= 1 << (mi * 9 + mj)
+                            if self.board[mi, mj] != 0:  # 駒がある場合、その先は見えない
+                                seen = False
+        return visible, attacks, king_pos
+
     def is_in_piece_vision(self, piece: int, pi: int, pj: int, i: int, j: int, player: int) -> bool:
         # 指定された駒の視界内に目標の位置があるかどうかを判定する
         moves = self.get_piece_moves(piece, pi, pj)
@@ -94,26 +219,53 @@ class FogShogiState:
                             actions.append((i, j, ni, nj, False))  # 成らない
 
         # 持ち駒の使用
-        for piece, count in self.captured_pieces[self.turn].items():
-            if count > 0:
-                for i in range(9):
-                    for j in range(9):
-                        if self.board[i, j] == 0 and self.is_visible(i, j, self.turn):
-                            if piece != 1 or (piece == 1 and 0 < i < 8):  # 歩は一段目と九段目には打てない
-                                if not self.is_two_pawns(piece, j):  # 二歩チェック
-                                    if not (piece == 1 and self.is_pawn_drop_mate(i, j)):  # 打ち歩詰めチェック
-                                        actions.append((-1, piece, i, j, False))  # -1は持ち駒を表す特別な値
-
-        # 王手を回避できないアクションを除外
+        offset = HAND_OFFSET[self.turn]
+        hand = [piece for piece in range(NUM_PIECE_TYPES) if self.hands[offset + piece] > 0]
+        if hand:
+            # update_fogで求めた視界から、打てる（見えている空き）マスを一度だけ列挙する
+            hidden = self.hidden_bits[self.turn]
+            drop_squares = [(i, j) for i in range(9) for j in range(9)
+                            if self.board[i, j] == 0 and not (hidden >> (i * 9 + j)) & 1]
+            if 1 in hand:
+                pawn_files = np.any(self.board == self.turn, axis=0)  # 自分の歩がある筋
+                mate_squares = self.get_pawn_drop_mate_squares(drop_squares)
+            for piece in hand:
+                for i, j in drop_squares:
+                    if piece == 1:
+                        if not 0 < i < 8:  # 歩は一段目と九段目には打てない
+                            continue
+                        if pawn_files[j]:  # 二歩チェック
+                            continue
+                        if (i, j) in mate_squares:  # 打ち歩詰めチェック
+                            continue
+                    actions.append((-1, piece, i, j, False))  # -1は持ち駒を表す特別な値
+
+        # 王手を回避できないアクションを除外（盤面を一時的に動かして自玉への利きを調べる）
+        king_pos = self.find_king(self.turn)
+        if king_pos is None:
+            return actions  # 玉がない場合は王手にならない
+
         legal_actions = []
         for action in actions:
-            new_state = FogShogiState()
-            new_state.board = np.copy(self.board)
-            new_state.turn = self.turn
-            new_state.hidden_info = {k: set(v) for k, v in self.hidden_info.items()}
-            new_state.captured_pieces = {k: dict(v) for k, v in self.captured_pieces.items()}
-            new_state.apply_action(action)
-            if not new_state.is_in_check(self.turn):
+            i, j, ni, nj, promote = action
+            captured = self.board[ni, nj]
+            if i == -1:
+                self.board[ni, nj] = j * self.turn
+                moved_king = j == 8
+            else:
+                moving = self.board[i, j]
+                self.board[ni, nj] = (abs(moving) + 10) * self.turn if promote else moving
+                self.board[i, j] = 0
+                moved_king = abs(moving) == 8
+            # 玉を動かした（取った玉を打った）場合は、find_kingと同じく盤面の先頭から玉を探し直す
+            king = tuple(int(v) for v in np.argwhere(self.board == 8 * self.turn)[0]) if moved_king else king_pos
+            # 適用後は相手の手番になるので、駒の向きは相手の手番で判定する
+            in_check = self.is_attacked_by(king[0], king[1], -self.turn, -self.turn)
+            # 元に戻す
+            if i != -1:
+                self.board[i, j] = moving
+            self.board[ni, nj] = captured
+            if not in_check:
                 legal_actions.append(action)
 
         return legal_actions
@@ -127,6 +279,21 @@ class FogShogiState:
                 return True
         return False
     
+    def get_pawn_drop_mate_squares(self, drop_squares: List[Tuple[int, int]]) -> Set[Tuple[int, int]]:
+        # 打ち歩詰めになる歩の打ち場所を求める
+        king_pos = self.find_king(-self.turn)
+        if king_pos is None:
+            return set()
+
+        ki, kj = king_pos
+        if self.attack_map[self.turn][ki, kj] > 0:
+            # 打つ前から相手玉に王手がかかっている局面（通常の対局では現れない）は玉の周囲をすべて調べる
+            candidates = [(i, j) for i, j in drop_squares if abs(ki - i) <= 1 and abs(kj - j) <= 1]
+        else:
+            # それ以外では、詰みになり得るのは玉の正面に打って王手をかける歩だけ
+            candidates = [(ki + self.turn, kj)] if (ki + self.turn, kj) in drop_squares else []
+        return {(i, j) for i, j in candidates if self.is_pawn_drop_mate(i, j)}
+
     def is_pawn_drop_mate(self, i: int, j: int) -> bool:
         # 打ち歩詰めのチェックを行う
         opponent_king_pos = self.find_king(-self.turn)
@@ -145,12 +312,8 @@ class FogShogiState:
         return is_mate
 
     def find_king(self, player: int) -> Optional[Tuple[int, int]]:
-        # プレイヤーの玉の位置を探す
-        for i in range(9):
-            for j in range(9):
-                if self.board[i, j] == 8 * player:
-                    return (i, j)
-        return None
+        # プレイヤーの玉の位置（update_fogで更新される）
+        return self.king_pos[player]
 
     def is_checkmate(self, player: int) -> bool:
         # 詰みの判定を行う
@@ -192,40 +355,73 @@ class FogShogiState:
 
     def is_square_attacked(self, i: int, j: int, attacker: int) -> bool:
         # 指定されたマスが攻撃されているかどうかを判定する
-        for ai in range(9):
-            for aj in range(9):
-                if self.board[ai, aj] * attacker > 0:
-                    piece = abs(self.board[ai, aj])
-                    moves = self.get_piece_moves(piece, ai, aj)
-                    if (i, j) in moves:
-                        return True
+        return self.is_attacked_by(i, j, attacker, self.turn)
+
+    def is_attacked_by(self, i: int, j: int, attacker: int, turn: int) -> bool:
+        # 対象のマスから8方向と桂馬の位置を逆にたどり、最初に当たる駒がそのマスに利いているかを調べる
+        # （get_piece_movesと同じく、歩・香・桂の向きはturnで決まる）
+        board = self.board
+        ki = i + 2 * turn
+        if 0 <= ki < 9:
+            for kj in (j - 1, j + 1):
+                if 0 <= kj < 9 and board[ki, kj] == 3 * attacker:
+                    return True
+
+        for di, dj in RAY_DIRECTIONS:
+            ni, nj = i + di, j + dj
+            distance = 1
+            while 0 <= ni < 9 and 0 <= nj < 9:
+                value = board[ni, nj]
+                if value != 0:
+                    if value * attacker > 0:
+                        piece = abs(value)
+                        # 駒からみた対象のマスの方向
+                        direction = (-di, -dj)
+                        if piece in (1, 2):
+                            reaches = direction == (-turn, 0) and (piece == 2 or distance == 1)
+                        else:
+                            reaches = direction in ATTACK_DIRECTIONS.get(piece, ()) and (distance == 1 or piece not in STEP_PIECES)
+                        if reaches:
+                            return True
+                    break
+                ni, nj = ni + di, nj + dj
+                distance += 1
         return False
 
     def apply_action(self, action: Tuple[int, int, int, int, bool]):
         # アクションを適用し、盤面を更新する
+        # ハッシュ値は変化したマスと持ち駒の分だけ差分で更新する
         i, j, ni, nj, promote = action
+        offset = HAND_OFFSET[self.turn]
+        h = self.zobrist_hash
         if i == -1:  # 持ち駒を使用する場合
             piece = j
+            count = self.hands[offset + piece]
             self.board[ni, nj] = piece * self.turn
-            self.captured_pieces[self.turn][piece] -= 1
-            if self.captured_pieces[self.turn][piece] == 0:
-                del self.captured_pieces[self.turn][piece]
+            h ^= piece_key(piece * self.turn, ni, nj)
+            h ^= hand_key(self.turn, piece, count) ^ hand_key(self.turn, piece, count - 1)
+            self.hands[offset + piece] = count - 1
         else:
-            captured_piece = abs(self.board[ni, nj])
+            captured_piece = abs(int(self.board[ni, nj]))
             if captured_piece != 0:
-                self.captured_pieces[self.turn][captured_piece] = self.captured_pieces[self.turn].get(captured_piece, 0) + 1
+                count = self.hands[offset + captured_piece]
+                h ^= piece_key(self.board[ni, nj], ni, nj)
+                h ^= hand_key(self.turn, captured_piece, count) ^ hand_key(self.turn, captured_piece, count + 1)
+                self.hands[offset + captured_piece] = count + 1
             
             moving_piece = abs(self.board[i, j])
+            h ^= piece_key(self.board[i, j], i, j)
             if promote:
                 self.board[ni, nj] = (moving_piece + 10) * self.turn  # 成った駒は元の駒の値+10とする
             else:
                 self.board[ni, nj] = self.board[i, j]
+            h ^= piece_key(self.board[ni, nj], ni, nj)
             self.board[i, j] = 0
 
         self.turn *= -1  # 手番を交代
+        self.zobrist_hash = h ^ TURN_KEY
+        self.position_counts[self.zobrist_hash] = self.position_counts.get(self.zobrist_hash, 0) + 1
         self.update_fog()  # 霧の効果を更新
-        if self.in_check:
-            print(f"Player {self.turn} is in check!")  # 王手の通知
 
     def get_piece_moves(self, piece: int, i: int, j: int) -> List[Tuple[int, int]]:
         # 指定された駒の移動可能な位置のリストを取得する
@@ -267,8 +463,8 @@ class FogShogiState:
         return moves
 
     def is_terminal(self) -> bool:
-        # 王が取られたらゲーム終了
-        return 8 not in self.board and -8 not in self.board
+        # 王が取られたら、または千日手になったらゲーム終了
+        return (8 not in self.board and -8 not in self.board) or self.is_repetition()
 
     def get_utility(self, player: int) -> float:
         if 8 not in self.board:
@@ -283,28 +479,101 @@ class FogShogiState:
         if king_pos is None:
             return False  # 玉がない場合は王手ではない
         ki, kj = king_pos
-        return self.is_square_attacked(ki, kj, -player)
+        return self.attack_map[-player][ki, kj] > 0  # update_fogで求めた利きの数を参照する
+
+class CFRProfiler:
+    """CFR探索の計測用カウンタとタイマー"""
+    COUNTERS = ('nodes', 'cache_lookups', 'cache_hits', 'info_sets_created', 'evaluations')
+    TIMERS = ('legal_actions', 'fog_update', 'evaluation')
 
-class FogShogiCFR:
     def __init__(self):
-        self.cache: Dict[str, float] = {}
+        self.reset()
+
+    def reset(self):
+        self.counters = {name: 0 for name in self.COUNTERS}
+        self.timers = {name: 0.0 for name in self.TIMERS}
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {'counters': dict(self.counters), 'timers': dict(self.timers)}
+
+    def merge(self, snapshot: Dict[str, Dict[str, float]]):
+        # ワーカーから返された計測値を合算する
+        for name, value in snapshot['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for name, value in snapshot['timers'].items():
+            self.timers[name] = self.timers.get(name, 0.0) + value
+
+    def report(self, elapsed: float) -> Dict[str, float]:
+        lookups = self.counters['cache_lookups']
+        return {
+            'elapsed_sec': elapsed,
+            **self.counters,
+            **{f"{name}_sec": value for name, value in self.timers.items()},
+            'cache_hit_rate': self.counters['cache_hits'] / lookups if lookups else 0.0,
+            'nodes_per_sec': self.counters['nodes'] / elapsed if elapsed > 0 else 0.0,
+            'info_sets_per_sec': self.counters['info_sets_created'] / elapsed if elapsed > 0 else 0.0,
+        }
+
+class FogShogiCFR:
+    def __init__(self, profile_path: Optional[str] = None, canonicalize: bool = False,
+                 abstraction: Optional[Dict[str, int]] = None):
+        self.profiler = CFRProfiler()
+        self.canonicalize = canonicalize  # Trueなら左右反転した情報集合を同一視する（推論側で反転して引けるのはabstractionを指定した場合だけ）
+        self.abstraction = abstraction  # 指定すると情報集合をabstraction.pyの設定でバケットにまとめる
+        self.profile_path = profile_path  # 指定するとバッチごとの計測結果をJSON Linesで追記する
+        self.cache: Dict[Tuple[str, int, int], float] = {}
         self.max_cache_size = 100000000
         self.cache_cleanup_threshold = 0.8
         self.regret_sum: Dict[str, Dict[Tuple[int, int, int, int], float]] = {}
         self.strategy_sum: Dict[str, Dict[Tuple[int, int, int, int], float]] = {}
+        # (後悔の差分, 戦略の差分)。分散学習のワーカーが設定すると、加算した量をここにも記録する
+        self.deltas: Optional[Tuple[Dict, Dict]] = None
+
+    def get_visible_board(self, state: FogShogiState) -> np.ndarray:
+        visible_board = state.board.copy()
+        visible_board[state.get_hidden_mask(state.turn)] = -1  # 見えない駒を-1で表現
+        return visible_board
+
+    def get_endpoint_values(self, state: FogShogiState) -> np.ndarray:
+        # エンドポイントが受け取る視界付き盤面と同じ表現（見えないマスの相手の駒は0、自分の駒は常に見える）
+        board = state.board
+        return np.where(state.get_hidden_mask(state.turn) & (board * state.turn <= 0), 0, board)
 
     def get_information_set(self, state: FogShogiState) -> str:
         # より詳細な情報を含める
-        visible_board = state.board.copy()
-        for pos in state.hidden_info[state.turn]:
-            visible_board[pos] = -1  # 見えない駒を-1で表現
-        return f"{visible_board.tobytes()}{state.turn}{state.captured_pieces}"
+        visible_board = self.get_visible_board(state)
+        return f"{visible_board.tobytes()}{state.turn}{bytes(state.hands)}"
+
+    def get_canonical_information_set(self, state: FogShogiState) -> Tuple[str, bool]:
+        # 霧の盤面とその左右反転のうち辞書順で小さい方を情報集合にする
+        # 反転した側を使った場合は、手も反転して戦略テーブルを参照する（2つ目の戻り値がTrue）
+        # 反転するかどうかは推論側と同じ基準で決めるため、エンドポイントと同じ盤面の表現で比べる
+        values = self.get_endpoint_values(state)
+        mirrored = self.canonicalize and is_mirror_smaller(values)
+        if self.abstraction is not None:
+            # 反転の判定に使った盤面をそのまま抽象化に渡す
+            return self.get_abstract_information_set(state, mirrored, values), mirrored
+        visible_board = self.get_visible_board(state)
+        if mirrored:
+            visible_board = np.ascontiguousarray(visible_board[:, ::-1])
+        return f"{visible_board.tobytes()}{state.turn}{bytes(state.hands)}", mirrored
+
+    def get_abstract_information_set(self, state: FogShogiState, mirrored: bool = False,
+                                     values: Optional[np.ndarray] = None) -> int:
+        # 自分の駒はすべて分かっているので、見えないマスのうち自分の駒以外だけを空きマスとして扱う
+        if values is None:
+            values = self.get_endpoint_values(state)
+        if mirrored:
+            values = values[:, ::-1]
+        return abstract_bucket(values.ravel().tolist(), state.turn, state.get_hand(state.turn),
+                               state.get_hand(-state.turn), self.abstraction)
 
     def get_strategy(self, info_set: str, actions: List[Tuple[int, int, int, int]]) -> Dict[Tuple[int, int, int, int], float]:
         # 既存の初期化部分を保持
         if info_set not in self.regret_sum:
             self.regret_sum[info_set] = {action: 0.0 for action in actions}
             self.strategy_sum[info_set] = {action: 0.0 for action in actions}
+            self.profiler.counters['info_sets_created'] += 1
 
         t = sum(self.strategy_sum[info_set].values()) + 1
         c = 2  # 探索の程度を制御するパラメータ。この値は調整可能です。
@@ -323,6 +592,17 @@ class FogShogiCFR:
         
         return {action: value / total for action, value in ucb_values.items()}
 
+    def add_to_tables(self, info_set, action: Tuple, regret: float, strategy: float):
+        # 後悔と戦略の合計に加算する（deltasが設定されていれば差分にも加算する）
+        self.regret_sum[info_set][action] = self.regret_sum[info_set].get(action, 0) + regret
+        self.strategy_sum[info_set][action] = self.strategy_sum[info_set].get(action, 0) + strategy
+        if self.deltas is not None:
+            regret_delta, strategy_delta = self.deltas
+            regret_entry = regret_delta.setdefault(info_set, {})
+            regret_entry[action] = regret_entry.get(action, 0) + regret
+            strategy_entry = strategy_delta.setdefault(info_set, {})
+            strategy_entry[action] = strategy_entry.get(action, 0) + strategy
+
     def parallel_cfr(self, player: int, num_processes: int = 32, iterations: int = 1000, batch_size: int = 100):
         results = []
         utilities = []
@@ -331,14 +611,23 @@ class FogShogiCFR:
         for batch_start in tqdm(range(0, iterations, batch_size), desc="Batch Progress"):
             batch_end = min(batch_start + batch_size, iterations)
             batch_iterations = batch_end - batch_start
+            batch_start_time = time.time()
             
             # バッチ内の反復処理を並列実行
-            batch_results = Parallel(n_jobs=num_processes, verbose=0)(
-                delayed(self.cfr_iteration)(iteration, player)
+            batch_outputs = Parallel(n_jobs=num_processes, verbose=0)(
+                delayed(self.profiled_cfr_iteration)(iteration, player)
                 for iteration in range(batch_start, batch_end)
             )
+            batch_results = [utility for utility, _ in batch_outputs]
             
             results.extend(batch_results)
+
+            # ワーカーごとの計測値をまとめて出力
+            batch_profiler = CFRProfiler()
+            for _, snapshot in batch_outputs:
+                batch_profiler.merge(snapshot)
+            profile = self.export_profile(batch_profiler, player, batch_start // batch_size + 1,
+                                          batch_iterations, time.time() - batch_start_time)
             
             # バッチの平均ユーティリティを計算
             batch_avg_utility = np.mean(batch_results)
@@ -348,10 +637,12 @@ class FogShogiCFR:
             print(f"\nBatch {batch_start//batch_size + 1} completed:")
             print(f"  Iterations: {batch_start+1}-{batch_end}")
             print(f"  Batch Average Utility: {batch_avg_utility:.4f}")
+            print(f"  Nodes/sec: {profile['nodes_per_sec']:.1f}, Cache Hit Rate: {profile['cache_hit_rate']:.2%}, "
+                  f"Info Sets/sec: {profile['info_sets_per_sec']:.1f}")
             
             # 定期的にモデルを保存
             if (batch_start + batch_size) % (batch_size * 10) == 0:
-                self.save_model(f"fog_shogi_cfr_player{player}_iter_{batch_end}.pkl")
+                self.save_model(f"fog_shogi_cfr_{self.mode_name(player)}_iter_{batch_end}.pkl")
             
             # メモリ使用量の最適化（必要に応じて）
             self.optimize_memory()
@@ -362,7 +653,7 @@ class FogShogiCFR:
         max_utility = max(results)
         min_utility = min(results)
         
-        print(f"\nPlayer {player} CFR Results:")
+        print(f"\n{self.mode_name(player)} CFR Results:")
         print(f"  Total Utility: {total_utility}")
         print(f"  Average Utility: {average_utility:.4f}")
         print(f"  Max Utility: {max_utility}")
@@ -381,6 +672,11 @@ class FogShogiCFR:
         
         return average_utility
 
+    @staticmethod
+    def mode_name(player: int) -> str:
+        # チェックポイント名などに使う学習の種類（両プレイヤー同時か、どちらか一方か）
+        return "both" if player == BOTH_PLAYERS else f"player{player}"
+
     def optimize_memory(self):
         # キャッシュのクリーンアップなど、メモリ最適化のロジックをここに実装
         if len(self.cache) > self.max_cache_size:
@@ -388,45 +684,81 @@ class FogShogiCFR:
             for _ in range(num_to_remove):
                 self.cache.popitem()
 
-    def cfr_iteration(self, iteration: int, player: int):
+    def export_profile(self, profiler: CFRProfiler, player: int, batch: int, iterations: int, elapsed: float):
+        # バッチの計測結果をJSONとして書き出す
+        record = {
+            'player': player,
+            'batch': batch,
+            'iterations': iterations,
+            **profiler.report(elapsed),
+            'cpu_percent': psutil.cpu_percent(),
+            'memory_percent': psutil.virtual_memory().percent,
+        }
+        if self.profile_path:
+            with open(self.profile_path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        return record
+
+    def profiled_cfr_iteration(self, iteration: int, player: int) -> Tuple[float, Dict[str, Dict[str, float]]]:
+        # 計測値をリセットしてから1イテレーション実行し、結果と計測値を返す
+        self.profiler.reset()
+        result = self.cfr_iteration(iteration, player)
+        return result, self.profiler.snapshot()
+
+    def cfr_iteration(self, iteration: int, player: int, max_depth: int = 8):
         state = FogShogiState()
-        result = self.cfr(state, player, 1.0, max_depth=8)
+        if player == BOTH_PLAYERS:
+            # 両プレイヤーを同時に更新する場合は先手から見た値を返す
+            result = self.cfr_simultaneous(state, (1.0, 1.0), max_depth=max_depth)[0]
+        else:
+            result = self.cfr(state, player, 1.0, max_depth=max_depth)
         if iteration % 5 == 0:  # 5イテレーションごとに進捗を表示
             print(f"Iteration: {iteration}, Player: {player}", end='\r')
             sys.stdout.flush()
         return result
 
     def cfr(self, state: FogShogiState, player: int, reach_probability: float, depth: int = 0, max_depth: int = 6) -> float:
-        if depth % 10 == 0:
-            print(f"Current depth: {depth}, Player: {player}", end='\r')
-            sys.stdout.flush()
+        profiler = self.profiler
+        profiler.counters['nodes'] += 1
 
         if state.is_terminal():
             return state.get_utility(player)
         
         if depth >= max_depth:
-            return self.evaluate_position(state, player)  # 評価関数の結果を返す
+            start = time.perf_counter()
+            value = self.evaluate_position(state, player)  # 評価関数の結果を返す
+            profiler.timers['evaluation'] += time.perf_counter() - start
+            profiler.counters['evaluations'] += 1
+            return value
 
-        info_set = self.get_information_set(state)
-        
-        cache_key = f"{info_set}_{player}_{depth}"
+        # キャッシュは情報集合（手番側から見える盤面・持ち駒）ごとに引く。局面全体のハッシュをキーにすると
+        # 見えないマスだけが違う局面を別々に展開することになり、探索するノードが大きく増える
+        cache_key = (self.get_information_set(state), player, depth)
+        profiler.counters['cache_lookups'] += 1
         if cache_key in self.cache:
+            profiler.counters['cache_hits'] += 1
             return self.cache[cache_key]
 
+        info_set, mirrored = self.get_canonical_information_set(state)
+
+        start = time.perf_counter()
         actions = state.get_legal_actions()
+        profiler.timers['legal_actions'] += time.perf_counter() - start
         if not actions:
             return 0
 
-        strategy = self.get_strategy(info_set, actions)
+        # 戦略テーブルは正規化した向きの手で管理する
+        table_actions = [mirror_action(action) for action in actions] if mirrored else actions
+        table_strategy = self.get_strategy(info_set, table_actions)
+        strategy = {action: table_strategy[table_action] for action, table_action in zip(actions, table_actions)}
         action_utilities = {}
 
         for action in actions:
-            new_state = FogShogiState()
-            new_state.board = np.copy(state.board)
-            new_state.turn = state.turn
-            new_state.hidden_info = {k: set(v) for k, v in state.hidden_info.items()}
-            new_state.captured_pieces = {k: dict(v) for k, v in state.captured_pieces.items()}
+            new_state = state.copy()
+            # apply_actionの処理時間の大半は霧の再計算（update_fog）
+            start = time.perf_counter()
             new_state.apply_action(action)
+            profiler.timers['fog_update'] += time.perf_counter() - start
 
             action_utilities[action] = -self.cfr(new_state, player, reach_probability * strategy[action], depth + 1, max_depth)
 
@@ -434,11 +766,81 @@ class FogShogiCFR:
 
         # 評価関数の結果を学習に反映
         if state.turn == player:
-            for action in actions:
+            for action, table_action in zip(actions, table_actions):
                 regret = reach_probability * (action_utilities[action] - utility)
                 learning_rate = 0.1  # 学習率を追加
-                self.regret_sum[info_set][action] = self.regret_sum[info_set].get(action, 0) + regret * learning_rate
-                self.strategy_sum[info_set][action] = self.strategy_sum[info_set].get(action, 0) + reach_probability * strategy[action] * learning_rate
+                self.add_to_tables(info_set, table_action, regret * learning_rate,
+                                   reach_probability * strategy[action] * learning_rate)
+
+        self.cache[cache_key] = utility
+        return utility
+
+    def cfr_simultaneous(self, state: FogShogiState, reach: Tuple[float, float], depth: int = 0,
+                         max_depth: int = 6) -> Tuple[float, float]:
+        """1回の走査で先手・後手の両方の後悔と戦略を更新する
+
+        reachは(先手の到達確率, 後手の到達確率)。戻り値は(先手から見た値, 後手から見た値)で、
+        それぞれ cfr(state, 1) と cfr(state, -1) と同じ符号の約束に従う。
+        手番側の後悔は相手の到達確率で、戦略の合計は自分の到達確率で重み付けする。
+        cfrは後悔・戦略の合計とも両者の手の確率を掛けた到達確率で重み付けするので、
+        値は同じでも学習されるテーブル（= 得られる戦略）はcfrを交互に呼ぶ場合と異なる。
+        """
+        profiler = self.profiler
+        profiler.counters['nodes'] += 1
+
+        if state.is_terminal():
+            utility = state.get_utility(1)
+            return utility, -utility
+
+        if depth >= max_depth:
+            # 評価関数はプレイヤーによって非対称なので、それぞれの視点で評価する
+            start = time.perf_counter()
+            values = (self.evaluate_position(state, 1), self.evaluate_position(state, -1))
+            profiler.timers['evaluation'] += time.perf_counter() - start
+            profiler.counters['evaluations'] += 2
+            return values
+
+        cache_key = (self.get_information_set(state), BOTH_PLAYERS, depth)
+        profiler.counters['cache_lookups'] += 1
+        if cache_key in self.cache:
+            profiler.counters['cache_hits'] += 1
+            return self.cache[cache_key]
+
+        info_set, mirrored = self.get_canonical_information_set(state)
+
+        start = time.perf_counter()
+        actions = state.get_legal_actions()
+        profiler.timers['legal_actions'] += time.perf_counter() - start
+        if not actions:
+            return 0, 0
+
+        table_actions = [mirror_action(action) for action in actions] if mirrored else actions
+        table_strategy = self.get_strategy(info_set, table_actions)
+        strategy = {action: table_strategy[table_action] for action, table_action in zip(actions, table_actions)}
+        turn_index = PLAYER_INDEX[state.turn]
+        action_utilities = {}
+
+        for action in actions:
+            new_state = state.copy()
+            start = time.perf_counter()
+            new_state.apply_action(action)
+            profiler.timers['fog_update'] += time.perf_counter() - start
+
+            # 到達確率は手番側の分だけ行動の確率を掛ける
+            child_reach = list(reach)
+            child_reach[turn_index] *= strategy[action]
+            first, second = self.cfr_simultaneous(new_state, tuple(child_reach), depth + 1, max_depth)
+            action_utilities[action] = (-first, -second)
+
+        utility = (sum(strategy[action] * action_utilities[action][0] for action in actions),
+                   sum(strategy[action] * action_utilities[action][1] for action in actions))
+
+        own_reach = reach[turn_index]
+        opponent_reach = reach[1 - turn_index]
+        learning_rate = 0.1
+        for action, table_action in zip(actions, table_actions):
+            regret = opponent_reach * (action_utilities[action][turn_index] - utility[turn_index])
+            self.add_to_tables(info_set, table_action, regret * learning_rate, own_reach * strategy[action] * learning_rate)
 
         self.cache[cache_key] = utility
         return utility
@@ -479,7 +881,7 @@ class FogShogiCFR:
                     score += position_bonus * piece_player
                     
                     # 可視駒のカウント
-                    if (i, j) not in state.hidden_info[player]:
+                    if not state.is_hidden(i, j, player):
                         visible_pieces[piece_player] += 1
                     
                     # 王の位置を記録
@@ -496,12 +898,12 @@ class FogShogiCFR:
                 ki, kj = king_pos[p]
                 king_safety = sum(1 for di in [-1, 0, 1] for dj in [-1, 0, 1]
                                   if 0 <= ki+di < 9 and 0 <= kj+dj < 9 and 
-                                  ((ki+di, kj+dj) in state.hidden_info[player] or state.board[ki+di][kj+dj] * p > 0))
+                                  (state.is_hidden(ki+di, kj+dj, player) or state.board[ki+di][kj+dj] * p > 0))
                 score += king_safety * 40 * p  # 霧も安全性として評価
         
         # 持ち駒の評価（霧将棋では持ち駒の価値が上がる可能性がある）
         for p in [1, -1]:
-            for piece, count in state.captured_pieces[p].items():
+            for piece, count in state.get_hand(p).items():
                 score += piece_values[piece] * count * 0.9 * p  # 持ち駒の価値を90%に設定
         
         # 中央支配の評価（情報収集の観点から重要）
@@ -568,20 +970,28 @@ class FogShogiCFR:
         
         return bonus
             
-    def train_parallel(self, iterations: int, num_processes: int, save_interval: int, filename: str):
+    def train_parallel(self, iterations: int, num_processes: int, save_interval: int, filename: str,
+                       simultaneous: bool = True):
+        # simultaneous=Trueなら1回の走査で両プレイヤーを更新し、Falseなら先手・後手を別々に走査する
         start_time = time.time()
         for i in range(0, iterations, save_interval):
             print(f"\nイテレーション {i+1}-{min(i+save_interval, iterations)}/{iterations} 開始")
             
-            print("先手のCFR開始")
-            avg_utility_player1 = self.parallel_cfr(1, num_processes, save_interval)
-            print("先手のCFR完了")
-            
-            print("後手のCFR開始")
-            avg_utility_player2 = self.parallel_cfr(-1, num_processes, save_interval)
-            print("後手のCFR完了")
-            
-            print(f"Average Utility - Player 1: {avg_utility_player1:.4f}, Player -1: {avg_utility_player2:.4f}")
+            if simultaneous:
+                print("先手・後手の同時CFR開始")
+                avg_utility_player1 = self.parallel_cfr(BOTH_PLAYERS, num_processes, save_interval)
+                print("先手・後手の同時CFR完了")
+                print(f"Average Utility - Player 1: {avg_utility_player1:.4f}")
+            else:
+                print("先手のCFR開始")
+                avg_utility_player1 = self.parallel_cfr(1, num_processes, save_interval)
+                print("先手のCFR完了")
+
+                print("後手のCFR開始")
+                avg_utility_player2 = self.parallel_cfr(-1, num_processes, save_interval)
+                print("後手のCFR完了")
+
+                print(f"Average Utility - Player 1: {avg_utility_player1:.4f}, Player -1: {avg_utility_player2:.4f}")
             
             self.save_model(f"{filename}_iter_{i+save_interval}.pkl")
             print(f"{i+save_interval} イテレーション完了")
@@ -606,30 +1016,36 @@ class FogShogiCFR:
         else:
             return {action: 1.0 / len(strategy_sum) for action in strategy_sum}
 
-    def save_model(self, filename: str):
-        """モデルをpickle形式でファイルに保存する"""
+    def save_model(self, filename: str, streaming: bool = False, compression: str = 'zlib'):
+        """モデルをファイルに保存する（streaming=Trueの場合はチャンク単位で圧縮して書き出す）"""
         if not os.path.exists('models'):
             os.makedirs('models')
         
         path = os.path.join('models', filename)
-        with open(path, 'wb') as f:
-            pickle.dump({
-                'regret_sum': self.regret_sum,
-                'strategy_sum': self.strategy_sum
-            }, f)
+        # 推論側で同じ正規化・抽象化を行うための設定
+        metadata = {'canonical': self.canonicalize, 'abstraction': self.abstraction}
+        if streaming:
+            # 辞書全体をpickle化しないので、保存時のピークメモリが増えない
+            save_model_stream(path, self.regret_sum, self.strategy_sum, compression=compression, metadata=metadata)
+        else:
+            with open(path, 'wb') as f:
+                pickle.dump({
+                    **metadata,
+                    'regret_sum': self.regret_sum,
+                    'strategy_sum': self.strategy_sum
+                }, f)
         print(f"モデルを {path} に保存しました。")
 
     @classmethod
     def load_model(cls, filename: str):
-        """pickle形式のファイルからモデルを読み込む"""
+        """pickle形式またはストリーミング形式のファイルからモデルを読み込む"""
         path = os.path.join('models', filename)
         if not os.path.exists(path):
             raise FileNotFoundError(f"モデルファイル {path} が見つかりません。")
 
-        with open(path, 'rb') as f:
-            data = pickle.load(f)
+        data = load_model_file(path)
         
-        model = cls()
+        model = cls(canonicalize=data.get('canonical', False), abstraction=data.get('abstraction'))
         model.regret_sum = data['regret_sum']
         model.strategy_sum = data['strategy_sum']
         print(f"モデルを {path} から読み込みました。")
@@ -641,7 +1057,7 @@ def monitor_resources():
 
 # 使用例
 def train_new_model():
-    cfr_model = FogShogiCFR()
+    cfr_model = FogShogiCFR(profile_path="training_profile.jsonl")
     num_processes = os.cpu_count()  # 利用可能なCPUコア数
     # num_processes = 48
     print(f"num_processes: {num_processes}")
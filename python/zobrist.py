@@ -0,0 +1,45 @@
+import random
+from typing import Dict
+
+# 対局をまたいで同じハッシュ値になるように固定のシードで乱数表を作る
+ZOBRIST_SEED = 20240914
+MAX_PIECE = 17  # 駒の数値表現の最大値（成り駒を含む）
+MAX_HAND_COUNT = 18  # 同じ種類の持ち駒の最大枚数
+
+_rng = random.Random(ZOBRIST_SEED)
+
+# PIECE_KEYS[駒の値 + MAX_PIECE][段 * 9 + 筋]（空きマスは0）
+PIECE_KEYS = [
+    [0] * 81 if value == 0 else [_rng.getrandbits(64) for _ in range(81)]
+    for value in range(-MAX_PIECE, MAX_PIECE + 1)
+]
+# HAND_KEYS[プレイヤー][駒][枚数]（0枚は0）
+HAND_KEYS = {
+    player: [[0] + [_rng.getrandbits(64) for _ in range(MAX_HAND_COUNT)] for _ in range(MAX_PIECE + 1)]
+    for player in (1, -1)
+}
+# 後手番のときに加えるキー
+TURN_KEY = _rng.getrandbits(64)
+
+
+def piece_key(value: int, i: int, j: int) -> int:
+    return PIECE_KEYS[value + MAX_PIECE][i * 9 + j]
+
+
+def hand_key(player: int, piece: int, count: int) -> int:
+    return HAND_KEYS[player][piece][count]
+
+
+def board_hash(board, turn: int, captured_pieces: Dict[int, Dict[int, int]]) -> int:
+    """盤面・持ち駒・手番から64ビットのZobristハッシュを計算する"""
+    h = 0
+    for i in range(9):
+        for j in range(9):
+            if board[i][j] != 0:
+                h ^= piece_key(int(board[i][j]), i, j)
+    for player, pieces in captured_pieces.items():
+        for piece, count in pieces.items():
+            h ^= hand_key(player, piece, count)
+    if turn == -1:
+        h ^= TURN_KEY
+    return h
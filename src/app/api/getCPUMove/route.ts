@@ -1,7 +1,7 @@
 import { NextResponse } from "next/server";
 
 export async function POST(request: Request) {
-  const { fullBoard, visibleBoard, player } = await request.json();
+  const { fullBoard, visibleBoard, player, capturedPieces } = await request.json();
 
   const AZURE_FUNCTION_URL = process.env.AZURE_FUNCTION_URL;
   const AZURE_FUNCTION_KEY = process.env.AZURE_FUNCTION_KEY;
@@ -18,6 +18,7 @@ export async function POST(request: Request) {
       fullBoard,
       visibleBoard,
       player,
+      capturedPieces,
     });
     const response = await fetch(AZURE_FUNCTION_URL, {
       method: "POST",
@@ -25,7 +26,7 @@ export async function POST(request: Request) {
         "Content-Type": "application/json",
         ...(AZURE_FUNCTION_KEY && { "x-functions-key": AZURE_FUNCTION_KEY }),
       },
-      body: JSON.stringify({ fullBoard, visibleBoard, player }),
+      body: JSON.stringify({ fullBoard, visibleBoard, player, capturedPieces }),
     });
 
     if (!response.ok) {
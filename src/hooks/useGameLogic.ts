@@ -570,6 +570,8 @@ export default function useGameLogic(
         fullBoard: fullBoard,
         visibleBoard: cpuVisibleBoard,
         player: cpuPlayer,
+        // 持ち駒は抽象化したモデルの情報集合に含まれるので一緒に送る
+        capturedPieces: capturedPieces,
       };
 
       const response = await fetch("/api/getCPUMove", {